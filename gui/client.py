@@ -1,19 +1,108 @@
 import argparse
-import json
 import os
-import struct
 import sys
-import time
-from socket import socket, AF_INET, SOCK_STREAM
+from queue import Queue, Empty
+from socket import create_connection, socket, AF_INET, SOCK_STREAM
+from threading import Thread
 
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(ROOT, "ml"))
 
-from net import recv
+from net import recv_msg, send_msg
 
 PORT = 7610
 
 
+class Client:
+    """
+    Autocomplete client for the GUI: keeps one connection to the server, used by a
+    background thread, so requests never block the caller.
+    Responses are streamed; notes are collected with poll(), e.g. once per frame.
+    """
+
+    def __init__(self, ip: str = "localhost", port: int = PORT, timeout: float = 30):
+        """
+        :param timeout: Seconds to wait for the server, to connect or to answer.
+        """
+        self.addr = (ip, port)
+        self.timeout = timeout
+        self.sock = None
+        # Whether the connection negotiated binary notes
+        self.binary = False
+        # Notes of the current request received so far
+        self.received = 0
+        self.requests = Queue()
+        self.results = Queue()
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def request(self, notes, tag=None):
+        """
+        Queue an autocomplete request.
+        :param notes: List of (note, start, end)
+        :param tag: Returned with the results, e.g. to know what the request was about.
+        """
+        self.requests.put((list(notes), tag))
+
+    def poll(self):
+        """
+        :return: List of (tag, notes, done, error) received since the last call, without
+            waiting. notes are the new notes of the request (possibly none), done is
+            True for its last result, and error is set if it failed.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Empty:
+                return results
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _connect(self):
+        self.sock = create_connection(self.addr, timeout=self.timeout)
+        # Binary notes if the server supports them (older servers answer with an error)
+        send_msg(self.sock, {"type": "hello", "formats": ["binary", "json"]})
+        self.binary = recv_msg(self.sock).get("format") == "binary"
+
+    def _stream(self, notes, tag):
+        if self.sock is None:
+            self._connect()
+        self.received = 0
+        send_msg(self.sock, {"type": "autocomplete", "data": notes, "stream": True}, self.binary)
+        while not (response := recv_msg(self.sock)).get("done"):
+            if "error" in response:
+                raise ValueError(response["error"])
+            self.received += 1
+            self.results.put((tag, [response["note"]], False, None))
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _loop(self):
+        while (req := self.requests.get()) is not None:
+            notes, tag = req
+            try:
+                try:
+                    self._stream(notes, tag)
+                except ConnectionError:
+                    # The server may have closed an idle connection; retry once on a
+                    # new one, unless part of the response already arrived.
+                    self._disconnect()
+                    if self.received:
+                        raise
+                    self._stream(notes, tag)
+                self.results.put((tag, [], True, None))
+            except (OSError, ValueError) as e:
+                self._disconnect()
+                self.results.put((tag, [], True, f"{type(e).__name__}: {e}"))
+        self._disconnect()
+
+
 def parse_input(path):
     msgs = []
     with open(path, "r") as f:
@@ -29,18 +118,6 @@ def write_output(path, data):
             f.write("\n")
 
 
-def recv(conn, length: int):
-    data = b""
-    tries = 0
-    while len(data) < length:
-        time.sleep(0.002)
-        data += conn.recv(length - len(data))
-        tries += 1
-        if tries > 1000:
-            raise Exception("recv timeout")
-    return data
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("input", help="Input messages file parsed by a function")
@@ -51,12 +128,8 @@ def main():
     sock = socket(AF_INET, SOCK_STREAM)
     sock.connect((args.ip, PORT))
     msgs = parse_input(args.input)
-    data = json.dumps({"type": "autocomplete", "data": msgs}).encode("utf-8")
-    sock.send(struct.pack("<I", len(data)))
-    sock.send(data)
-    length = struct.unpack("<I", sock.recv(4))[0]
-    pred = recv(sock, length)
-    data = json.loads(pred.decode("utf-8"))
+    send_msg(sock, {"type": "autocomplete", "data": msgs})
+    data = recv_msg(sock)
     write_output(args.output, data["data"])
 
 
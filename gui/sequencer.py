@@ -1,10 +1,10 @@
 import os
-import sys
 import time
-from subprocess import run
 
 import pygame
 
+from client import Client
+
 ROOT = os.path.dirname(os.path.abspath(__file__))
 
 AUDIO = [pygame.mixer.Sound(os.path.join(ROOT, "audio", f"{i}.mp3")) for i in range(88)]
@@ -33,6 +33,16 @@ class Sequencer:
         self.recording = False
         self.play_start_time = 0
         self.play_start_ptr = 0
+        # Autocomplete requests go through a background connection to the server
+        self.client = Client(ip)
+        self.completing = False
+
+    def play(self, pointer):
+        self.playing = True
+        self.pointer = pointer
+        self.play_start_time = time.time()
+        self.play_start_ptr = pointer
+        self.audio_played = [False] * len(self.messages)
 
     def ch_to_y(self, ch):
         return int(ch / 88 * 450 + 51)
@@ -69,6 +79,8 @@ class Sequencer:
         if self.playing or self.recording:
             col = (255, 60, 60) if self.recording else (60, 60, 255)
             pygame.draw.circle(surface, col, (20, 70), 10)
+        elif self.completing:
+            pygame.draw.circle(surface, (255, 200, 60), (20, 70), 10)
 
         # Update
         # Pointer
@@ -86,10 +98,7 @@ class Sequencer:
                 if rec:
                     self.recording = True
                     self.pending_messages = {}
-                self.playing = True
-                self.play_start_time = time.time()
-                self.play_start_ptr = self.pointer
-                self.audio_played = [False] * len(self.messages)
+                self.play(self.pointer)
 
         # Set ptr for playing
         if self.playing:
@@ -132,21 +141,22 @@ class Sequencer:
             self.messages = []
 
         # Autocomplete
-        if not self.playing and self.buttons.complete.is_clicked(events):
-            # Serialize messages to file
-            with open(os.path.join(ROOT, "in.txt"), "w") as f:
-                for msg in self.messages:
-                    f.write(f"{msg[0]} {msg[1]} {msg[2]}")
-
-            # Call completion
-            proc = run([sys.executable, os.path.join(ROOT, "client.py"), os.path.join(ROOT, "in.txt"), os.path.join(ROOT, "out.txt"), "--ip", self.ip])
-            if proc.returncode != 0:
-                print("Error in calling completion.")
-            else:
-                last_time = max([msg[2] for msg in self.messages]) if self.messages else 0
-                with open(os.path.join(ROOT, "out.txt")) as f:
-                    for line in f.read().strip().split("\n"):
-                        parts = line.split(" ")
-                        msg = (int(parts[0]), float(parts[1])+last_time, float(parts[2])+last_time)
-                        if 0 <= msg[1] and msg[2] <= self.duration and 0 <= msg[0] < 88:
-                            self.messages.append(msg)
+        if not self.playing and not self.completing and self.buttons.complete.is_clicked(events):
+            last_time = max([msg[2] for msg in self.messages]) if self.messages else 0
+            self.client.request(self.messages, tag=last_time)
+            self.completing = True
+            # Notes are streamed: play from the end of the prompt while they arrive
+            if last_time < self.duration:
+                self.play(last_time / self.duration)
+
+        for last_time, notes, done, error in self.client.poll():
+            if done:
+                self.completing = False
+            if error is not None:
+                print("Error in calling completion:", error)
+            for note in notes:
+                msg = (int(note[0]), float(note[1])+last_time, float(note[2])+last_time)
+                if 0 <= msg[1] and msg[2] <= self.duration and 0 <= msg[0] < 88:
+                    self.messages.append(msg)
+                    if self.playing and not self.recording:
+                        self.audio_played.append(False)
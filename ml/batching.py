@@ -0,0 +1,119 @@
+"""
+Dynamic batching of autocomplete requests.
+Requests that arrive within a short window are decoded together in one batch.
+"""
+
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
+
+from run import generate_batch
+from transformer import TransformerModel
+
+
+class Request:
+    def __init__(self, tokens, length: int, on_token=None):
+        """
+        :param tokens: 1D tensor, the prompt.
+        :param length: Number of tokens to generate.
+        :param on_token: Called as on_token(i, token) in the worker thread when the i-th
+            token is generated, before the future resolves.
+        """
+        self.tokens = tokens
+        self.length = length
+        self.on_token = on_token
+        self.future = Future()
+        self.submit_time = time.time()
+        # Seconds spent waiting for a batch; set when decoding starts.
+        self.queue_latency = None
+
+
+class Batcher:
+    """
+    Collects waiting requests and decodes them with generate_batch in a worker thread.
+    A batch is started once max_batch requests are waiting, or max_wait seconds
+    after the first one arrived.
+    """
+
+    def __init__(self, model: TransformerModel, max_batch: int = 8, max_wait: float = 0.01):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Finish the requests already queued, then stop the worker.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, tokens, length: int = 16, on_token=None) -> Future:
+        """
+        Queue a prompt for generation.
+        :param on_token: To stream the tokens, see Request.
+        :return: Future resolving to the list of generated tokens.
+        """
+        req = Request(tokens, length, on_token)
+        self.queue.put(req)
+        return req.future
+
+    def _collect(self):
+        """
+        Block until a batch is ready.
+        :return: List of requests, or None if stopped.
+        """
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.submit_time + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                req = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if req is None:
+                # Let the loop see the stop signal after this batch.
+                self.queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _loop(self):
+        while (batch := self._collect()) is not None:
+            batch = [req for req in batch if req.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.time()
+            for req in batch:
+                req.queue_latency = start - req.submit_time
+
+            def on_step(step, tokens):
+                for req, token in zip(batch, tokens):
+                    if req.on_token is not None and step < req.length:
+                        req.on_token(step, token)
+
+            streaming = any(req.on_token is not None for req in batch)
+            try:
+                preds = generate_batch(self.model, [req.tokens for req in batch],
+                                       max(req.length for req in batch),
+                                       on_step=on_step if streaming else None)
+            except Exception as e:
+                for req in batch:
+                    req.future.set_exception(e)
+                continue
+            for req, pred in zip(batch, preds):
+                req.future.set_result(pred[:req.length])
+
+            latencies = ", ".join(f"{req.queue_latency*1000:.1f}" for req in batch)
+            print(f"Batch of {len(batch)}: queue ms [{latencies}], "
+                  f"decode ms {(time.time()-start)*1000:.1f}")
@@ -0,0 +1,124 @@
+"""
+Cache of tokenized datasets, one entry per (MIDI directory, tokenizer config).
+
+Each entry is a dataset directory (see dataset.py), built and kept up to date by
+midi.get_dataset, plus meta.json recording its config and when it was last used.
+When the cache is over its disk budget, the least recently used entries are deleted.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Optional
+
+from dataset import TokenStream, open_dataset
+from midi import DT, INTERVALS, get_dataset
+
+CACHE_DIR = "results/cache"
+META = "meta.json"
+
+
+def tokenizer_config(dt: float = DT, max_consec: int = 2):
+    """
+    Everything that changes the tokens of a file.
+    """
+    return {"dt": dt, "intervals": INTERVALS, "max_consec": max_consec}
+
+def entry_key(midi_dir: str, config) -> str:
+    """
+    Name of the cache entry of a MIDI directory and tokenizer config.
+    """
+    h = hashlib.sha1(json.dumps([os.path.abspath(midi_dir), config], sort_keys=True).encode())
+    return f"dt{config['dt']}_{h.hexdigest()[:12]}"
+
+def dir_size(dir: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(dir) if entry.is_file())
+
+
+class DatasetCache:
+    """
+    Entries requested through one DatasetCache are never evicted by it, so that e.g.
+    a sweep can hold the datasets of all its dts even if they exceed the budget.
+    """
+
+    def __init__(self, dir: str = CACHE_DIR, budget_gb: Optional[float] = None):
+        """
+        :param budget_gb: Max total size of the cache; None for no limit.
+        """
+        self.dir = dir
+        self.budget = None if budget_gb is None else budget_gb * 2**30
+        self.pinned = set()
+
+    def path(self, midi_dir: str, dt: float = DT, max_consec: int = 2) -> str:
+        return os.path.join(self.dir, entry_key(midi_dir, tokenizer_config(dt, max_consec)))
+
+    def open(self, midi_dir: str, dt: float = DT, max_consec: int = 2) -> Optional[TokenStream]:
+        """
+        Cached dataset of midi_dir as it is, without building or updating it.
+        :return: The dataset, or None if it isn't cached.
+        """
+        path = self.path(midi_dir, dt, max_consec)
+        if not os.path.isfile(os.path.join(path, META)):
+            return None
+        return open_dataset(path)
+
+    def get(self, midi_dir: str, dt: float = DT, max_consec: int = 2,
+            workers: Optional[int] = None) -> Optional[TokenStream]:
+        """
+        Dataset of midi_dir tokenized with dt and max_consec. Built if it isn't cached;
+        updated if files were added or changed since. If midi_dir doesn't exist, the
+        cached entry is used as is.
+
+        :return: The dataset, or None if neither midi_dir nor an entry exist.
+        """
+        config = tokenizer_config(dt, max_consec)
+        path = self.path(midi_dir, dt, max_consec)
+        if os.path.isdir(midi_dir):
+            data = get_dataset(midi_dir, path, dt, max_consec, workers)
+        elif os.path.isfile(os.path.join(path, META)):
+            data = open_dataset(path)
+        else:
+            return None
+
+        meta = {"midi_dir": os.path.abspath(midi_dir), "config": config, "last_used": time.time()}
+        tmp = os.path.join(path, f"{META}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, META))
+
+        self.pinned.add(os.path.basename(path))
+        self.evict()
+        return data
+
+    def entries(self):
+        """
+        :return: List of (name, meta, size in bytes), least recently used first.
+        """
+        entries = []
+        if os.path.isdir(self.dir):
+            for name in os.listdir(self.dir):
+                path = os.path.join(self.dir, name, META)
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        meta = json.load(f)
+                    entries.append((name, meta, dir_size(os.path.dirname(path))))
+        return sorted(entries, key=lambda e: e[1]["last_used"])
+
+    def evict(self):
+        """
+        Delete least recently used entries (except pinned ones) until within budget.
+        """
+        if self.budget is None:
+            return
+        entries = self.entries()
+        total = sum(size for name, meta, size in entries)
+        for name, meta, size in entries:
+            if total <= self.budget:
+                break
+            if name in self.pinned:
+                continue
+            print(f"Evicting {name} from dataset cache ({size / 2**20:.1f} MB)")
+            shutil.rmtree(os.path.join(self.dir, name))
+            total -= size
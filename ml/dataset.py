@@ -0,0 +1,230 @@
+"""
+On disk token dataset: flat uint8 shards plus an index.
+
+A dataset directory contains:
+    00000.bin, 00001.bin, ...  Raw uint8 tokens.
+    index.json                 {"segments": [[shard, offset, length], ...]}
+The token stream is the concatenation of the segments, in index order.
+Shards are memory mapped when read, so the stream is never fully loaded.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+
+INDEX = "index.json"
+# Max tokens per shard file.
+SHARD_SIZE = 1 << 28
+
+
+def read_index(dir: str):
+    """
+    :return: List of segments [shard, offset, length].
+    """
+    path = os.path.join(dir, INDEX)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return json.load(f)["segments"]
+
+def write_index(dir: str, segments):
+    """
+    Atomically replace the index of a dataset.
+    """
+    path = os.path.join(dir, INDEX)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"segments": segments}, f)
+    os.replace(path + ".tmp", path)
+
+
+class ShardWriter:
+    """
+    Appends token sequences to new shards of a dataset directory.
+    Existing shards are left untouched; the new segments are added to the index on close.
+    """
+
+    def __init__(self, dir: str, shard_size: int = SHARD_SIZE):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.shard_size = shard_size
+        self.segments = read_index(dir)
+        shards = [int(f[:-4]) for f in os.listdir(dir) if f.endswith(".bin")]
+        self.next_shard = max(shards, default=-1) + 1
+        self.file = None
+        self.shard = None
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, tokens):
+        """
+        Append one token sequence.
+        :return: The segment [shard, offset, length] it was written to.
+        """
+        tokens = np.ascontiguousarray(tokens, dtype=np.uint8)
+        if self.file is None or (self.pos > 0 and self.pos + len(tokens) > self.shard_size):
+            self._new_shard()
+        self.file.write(tokens.tobytes())
+        segment = [self.shard, self.pos, len(tokens)]
+        self.pos += len(tokens)
+        self.segments.append(segment)
+        return segment
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        write_index(self.dir, self.segments)
+
+    def _new_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard = f"{self.next_shard:05d}.bin"
+        self.next_shard += 1
+        self.file = open(os.path.join(self.dir, self.shard), "wb")
+        self.pos = 0
+
+
+class TokenStream:
+    """
+    Read only concatenation of token arrays (usually memmapped segments).
+    Indexing with a slice copies only the requested range.
+    """
+
+    def __init__(self, segments, files=None):
+        """
+        :param files: For memmapped segments, (path, offset, length) of each one, else None.
+            Those are pickled by reference (e.g. for DataLoader workers) instead of by value.
+        """
+        if files is None:
+            files = [None] * len(segments)
+        keep = [i for i, s in enumerate(segments) if len(s) > 0]
+        self.segments = [segments[i] for i in keep]
+        self.files = [files[i] for i in keep]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.segments])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key: slice) -> np.ndarray:
+        start, stop, step = key.indices(len(self))
+        assert step == 1, "Only contiguous slices are supported"
+        pieces = []
+        i = np.searchsorted(self.offsets, start, side="right") - 1
+        while start < stop:
+            seg_start = start - self.offsets[i]
+            seg_stop = min(stop - self.offsets[i], len(self.segments[i]))
+            pieces.append(self.segments[i][seg_start:seg_stop])
+            start = self.offsets[i] + seg_stop
+            i += 1
+        if not pieces:
+            return np.zeros(0, dtype=np.uint8)
+        return np.concatenate(pieces)
+
+    def __getstate__(self):
+        segments = [seg if file is None else None for seg, file in zip(self.segments, self.files)]
+        return {"segments": segments, "files": self.files}
+
+    def __setstate__(self, state):
+        mapped = map_files([file for file in state["files"] if file is not None])[::-1]
+        segments = [mapped.pop() if file is not None else seg
+                    for seg, file in zip(state["segments"], state["files"])]
+        self.__init__(segments, state["files"])
+
+    def slice(self, start: int, stop: int) -> "TokenStream":
+        """
+        View of tokens [start, stop), without copying.
+        """
+        segments = []
+        files = []
+        for i, seg in enumerate(self.segments):
+            seg_start = max(start - self.offsets[i], 0)
+            seg_stop = min(stop - self.offsets[i], len(seg))
+            if seg_start < seg_stop:
+                segments.append(seg[seg_start:seg_stop])
+                file = self.files[i]
+                if file is not None:
+                    file = (file[0], file[1] + int(seg_start), int(seg_stop - seg_start))
+                files.append(file)
+        return TokenStream(segments, files)
+
+
+def map_files(files):
+    """
+    :param files: List of (path, offset, length)
+    :return: List of memmapped arrays, sharing one map per file.
+    """
+    maps = {}
+    segments = []
+    for path, offset, length in files:
+        if path not in maps:
+            maps[path] = np.memmap(path, dtype=np.uint8, mode="r")
+        segments.append(maps[path][offset:offset+length])
+    return segments
+
+def open_dataset(dir: str) -> TokenStream:
+    files = [(os.path.join(dir, shard), offset, length)
+             for shard, offset, length in read_index(dir) if length > 0]
+    return TokenStream(map_files(files), files)
+
+def load_tokens(path: str) -> TokenStream:
+    """
+    Open a dataset directory, or a tensor saved with torch.save (old format).
+    """
+    if os.path.isdir(path):
+        return open_dataset(path)
+    return TokenStream([torch.load(path).numpy().astype(np.uint8)])
+
+
+class WindowSampler(torch.utils.data.IterableDataset):
+    """
+    Batches of windows of bptt+1 consecutive tokens, at random offsets in a TokenStream.
+    Yields LongTensor of shape [bptt + 1, batch_size].
+
+    Offsets of an epoch are drawn up front from a generator seeded by (seed, rank, epoch), so
+    batches are reproducible whatever the number of DataLoader workers, which split the
+    steps round robin. Use with DataLoader(sampler, batch_size=None, num_workers=n).
+    """
+
+    def __init__(self, data: TokenStream, bptt: int, batch_size: int, steps: int,
+                 seed: int = 0, rank: int = 0):
+        assert len(data) > bptt, "Not enough tokens for one window"
+        self.data = data
+        self.bptt = bptt
+        self.batch_size = batch_size
+        self.steps = steps
+        self.seed = seed
+        self.rank = rank
+        self.epoch = 0
+        self.start_step = 0
+
+    def set_epoch(self, epoch: int, start_step: int = 0):
+        """
+        :param start_step: Skip the first steps of the epoch (when resuming).
+        """
+        self.epoch = epoch
+        self.start_step = start_step
+
+    def __len__(self):
+        return self.steps
+
+    def offsets(self) -> np.ndarray:
+        """
+        :return: Shape [steps, batch_size]; start of each window this epoch.
+        """
+        rng = np.random.default_rng([self.seed, self.rank, self.epoch])
+        return rng.integers(0, len(self.data) - self.bptt, size=(self.steps, self.batch_size))
+
+    def __iter__(self):
+        offsets = self.offsets()
+        info = torch.utils.data.get_worker_info()
+        worker, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        for step in range(self.start_step + worker, self.steps, num_workers):
+            windows = [self.data[o:o+self.bptt+1] for o in offsets[step]]
+            yield torch.from_numpy(np.stack(windows, axis=1)).long()
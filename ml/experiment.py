@@ -1,53 +1,236 @@
+"""
+Hyperparameter sweeps: train every combination of a grid, several trials at a time.
+
+python experiment.py --dt 0.5 0.25 0.125 0.0625 --netsize 128 256 --jobs 4 --epochs 20
+
+Grid flags take several values: --dt, --netsize (emsize and d_hid), --nlayers, --bptt.
+Other flags are passed to every trial's Config (see model.py).
+
+Each trial gets a process pinned to its own cores, and trains into
+<out>/<trial name>/ (logs as in model.py, stdout in log.txt, results in trial.json).
+Trials whose best validation loss is worse than the median of the others with the same
+dt (losses of different dts aren't comparable) at the same epoch are stopped early. At the end a comparison table is printed and saved to
+<out>/summary.csv.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import asdict, replace
+from statistics import median
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
-DT = (0.5, 0.25, 0.125, 0.0625)
-NETSIZE = (64, 128, 256, 512, 1024)
+from dataset import load_tokens
+from cache import DatasetCache
+from model import Config, Trainer
 
+GRID = ("dt", "netsize", "nlayers", "bptt")
 
-def exp_dt():
-    for i in DT:
-        print(f"@@@@@@@@ dt = {i} @@@@@@@@@")
-        os.system(f"python model.py --dt {i}")
-        os.system(f"mv log.txt log_{i}.txt")
 
-def plot_dt():
-    for i in DT:
-        with open(f"log_{i}.txt") as f:
-            vals = map(float, f.read().strip().split("\n"))
-            vals = np.array(list(vals))
-            plt.plot(vals, label=f"dt = {i}")
-    plt.legend()
-    plt.show()
+class SweepTrainer(Trainer):
+    """
+    Trainer that also stops when doing worse than the other trials with the same dt
+    (median stopping rule). Different dts tokenize differently, so their losses per
+    token aren't compared.
+    """
+
+    def __init__(self, cfg: Config, name: str, history, grace: int):
+        """
+        :param history: Dict shared by all trials (Manager dict): (dt, name) -> validation losses.
+        :param grace: Epochs before a trial can be stopped by the others.
+        """
+        super().__init__(cfg)
+        self.name = name
+        self.history = history
+        self.grace = grace
+
+    def should_stop(self, epoch: int, val_loss: float, best_val_loss: float) -> bool:
+        if super().should_stop(epoch, val_loss, best_val_loss):
+            return True
+        key = (self.cfg.dt, self.name)
+        losses = self.history.get(key, []) + [val_loss]
+        self.history[key] = losses
+        if epoch < self.grace:
+            return False
+        others = [min(h[:len(losses)]) for (dt, name), h in self.history.items()
+                  if dt == self.cfg.dt and name != self.name and len(h) >= len(losses)]
+        return len(others) >= 2 and min(losses) > median(others)
+
+
+def trial_name(params) -> str:
+    return "_".join(f"{key}{value}" for key, value in params.items())
+
+def trial_config(base: Config, params, out: str) -> Config:
+    params = dict(params)
+    if "netsize" in params:
+        params["emsize"] = params["d_hid"] = params.pop("netsize")
+    return replace(base, **params, results=out, resume=None)
+
+
+def init_worker(slots):
+    """
+    Pin this pool process to the next free set of cores.
+    """
+    cores = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
 
+def run_trial(name: str, params, cfg: Config, history, grace: int):
+    """
+    Pool task: train one trial, with its output going to <results>/log.txt.
+    :return: (name, result dict), also saved as trial.json.
+    """
+    os.makedirs(cfg.results, exist_ok=True)
+    start = time.time()
+    with open(os.path.join(cfg.results, "log.txt"), "w") as log, \
+            redirect_stdout(log), redirect_stderr(log):
+        result = SweepTrainer(cfg, name, history, grace).main_training_loop()
 
-def exp_netsize():
-    for i in NETSIZE:
-        print(f"@@@@@@@@ netsize = {i} @@@@@@@@@")
-        os.system(f"python model.py --netsize {i}")
-        os.system(f"mv log.txt log_{i}.txt")
+    with open(os.path.join(cfg.results, "throughput.jsonl")) as f:
+        perf = [json.loads(line) for line in f]
+    result = {
+        **params,
+        **result,
+        "hours": (time.time() - start) / 3600,
+        "tokens_per_sec": np.mean([p["tokens_per_sec"] for p in perf]) if perf else 0,
+        "cores": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "config": asdict(cfg),
+    }
+    with open(os.path.join(cfg.results, "trial.json"), "w") as f:
+        json.dump(result, f, indent=4)
+    return name, result
 
-def plot_netsize():
-    for i in NETSIZE:
-        with open(f"log_{i}.txt") as f:
-            vals = map(float, f.read().strip().split("\n"))
-            vals = np.array(list(vals))
-            plt.plot(vals, label=f"netsize = {i}")
+
+def sweep(base: Config, grid, out: str, jobs: int, grace: int = 3):
+    """
+    :param grid: Dict of GRID key -> list of values.
+    :param jobs: Trials running at once. Available cores are split evenly between them.
+    :param grace: Epochs before a trial can be stopped for being worse than the median.
+    :return: List of trial results (dicts), best first.
+    """
+    keys = [key for key in GRID if key in grid]
+    trials = {}
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(zip(keys, values))
+        name = trial_name(params)
+        trials[name] = (params, trial_config(base, params, os.path.join(out, name)))
+
+    if base.data is None:
+        # Datasets are built (or found in the cache) once by the sweep, not per trial.
+        cache = DatasetCache(base.cache_dir, base.cache_gb)
+        for dt in sorted({cfg.dt for params, cfg in trials.values()}):
+            print(f"Dataset for dt = {dt}")
+            cache.get(base.midi_dir, dt)
+        trials = {name: (params, replace(cfg, data=cache.path(base.midi_dir, cfg.dt)))
+                  for name, (params, cfg) in trials.items()}
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    jobs = max(1, min(jobs, len(trials)))
+    per_job = max(len(cores) // jobs, 1)
+    print(f"{len(trials)} trials, {jobs} at a time with {per_job} cores each")
+
+    # Spawn: fresh interpreters, not forks of a process that already started torch threads.
+    ctx = multiprocessing.get_context("spawn")
+    slots = ctx.Queue()
+    for i in range(jobs):
+        # More jobs than cores share them.
+        slots.put([cores[(i*per_job + j) % len(cores)] for j in range(per_job)])
+    results = []
+    with ctx.Manager() as manager, \
+            ProcessPoolExecutor(jobs, mp_context=ctx, initializer=init_worker, initargs=(slots,)) as pool:
+        history = manager.dict()
+        futures = [pool.submit(run_trial, name, params, cfg, history, grace)
+                   for name, (params, cfg) in trials.items()]
+        for future in as_completed(futures):
+            try:
+                name, result = future.result()
+            except Exception as e:
+                print(f"Trial failed: {type(e).__name__}: {e}")
+                continue
+            results.append(result)
+            print(f"{len(results)}/{len(trials)} {name}: best val loss {result['best_val_loss']:.4f} "
+                  f"after {result['epochs']} epochs{' (stopped early)' if result['stopped_early'] else ''}")
+
+    results.sort(key=lambda r: r["best_val_loss"])
+    columns = [key for key in results[0] if key != "config"] if results else []
+    with open(os.path.join(out, "summary.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+def format_table(results) -> str:
+    """
+    Comparison table of sweep results, as text.
+    """
+    if not results:
+        return "No results"
+    columns = [key for key in results[0] if key != "config"]
+    cells = [[f"{r[c]:.4g}" if isinstance(r[c], float) else str(r[c]) for c in columns]
+             for r in results]
+    widths = [max(len(row[i]) for row in cells + [columns]) for i in range(len(columns))]
+    lines = [" | ".join(c.rjust(w) for c, w in zip(row, widths)) for row in [columns] + cells]
+    lines.insert(1, "-+-".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+
+def plot_sweep(out: str):
+    """
+    Validation loss of every trial of a sweep.
+    """
+    for name in sorted(os.listdir(out)):
+        path = os.path.join(out, name, "logval.csv")
+        if os.path.isfile(path):
+            plt.plot(np.loadtxt(path, skiprows=1, ndmin=1), label=name)
+    plt.title("Validation loss")
     plt.legend()
     plt.show()
 
 
-def plot_data():
-    data = torch.load("all_data.pt")
-    plot = np.empty((128,), dtype=int)
-    for i in range(128):
-        plot[i] = (data == i).sum()
-    plt.plot(plot)
+def plot_data(path: str):
+    """
+    Histogram of tokens in a dataset.
+    """
+    data = load_tokens(path)
+    plt.plot(np.bincount(data[:], minlength=128))
     plt.show()
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep. "
+                                     "Other arguments are passed to every trial's Config.")
+    parser.add_argument("--dt", type=float, nargs="+")
+    parser.add_argument("--netsize", type=int, nargs="+", help="Sets emsize and d_hid")
+    parser.add_argument("--nlayers", type=int, nargs="+")
+    parser.add_argument("--bptt", type=int, nargs="+")
+    parser.add_argument("--out", default="results/sweep", help="Trial results go here")
+    parser.add_argument("--jobs", type=int, default=4, help="Trials running at once")
+    parser.add_argument("--grace", type=int, default=3,
+                        help="Epochs before a trial can be stopped for being worse than the median")
+    parser.add_argument("--plot", action="store_true", help="Plot the results of --out and exit")
+    args, rest = parser.parse_known_args()
+
+    if args.plot:
+        plot_sweep(args.out)
+        return
+    base = Config.from_args(rest)
+    grid = {key: getattr(args, key) for key in GRID if getattr(args, key) is not None}
+    if not grid:
+        parser.error("Nothing to sweep; give several values to at least one of --" + ", --".join(GRID))
+
+    results = sweep(base, grid, args.out, args.jobs, args.grace)
+    print(format_table(results))
+
+
 if __name__ == "__main__":
-    plot_data()
+    main()
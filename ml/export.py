@@ -0,0 +1,194 @@
+"""
+Export a trained model as a TorchScript decoding graph, for serving without Python
+model code (load with torch.jit.load, or run.load_inference_model).
+
+python export.py --model results/model.pt --out results/model.ts
+
+The graph has the same forward_cached interface as TransformerModel, so generate,
+generate_batch and the server use it unchanged. Keys and values are written into
+buffers of fixed size [nlayers, batch_size, nhead, max_len, head_dim], allocated once
+per sequence, instead of being concatenated at every step. The positional encoding
+table, embedding scale and masks are computed inside the graph.
+
+After exporting, the graph is checked against the eager model (parity test), and
+their per token latency is compared.
+"""
+
+import argparse
+import math
+from typing import Optional, Tuple
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+
+from run import MODEL_PATH, time_generation
+from transformer import TransformerModel, load_model
+
+# Max positions (prompt + generated) per sequence.
+MAX_LEN = 512
+
+
+class ExportLayer(nn.Module):
+    """
+    One encoder layer, as in cached_layer_forward (post-norm, relu).
+    """
+
+    def __init__(self, layer: nn.TransformerEncoderLayer):
+        super().__init__()
+        attn = layer.self_attn
+        d_model = attn.embed_dim
+        assert layer.activation is F.relu and not layer.norm_first, "Only the default layer is supported"
+        self.nhead = attn.num_heads
+        self.in_proj = nn.Linear(d_model, 3 * d_model)
+        self.in_proj.weight.data.copy_(attn.in_proj_weight)
+        self.in_proj.bias.data.copy_(attn.in_proj_bias)
+        self.out_proj = nn.Linear(d_model, d_model)
+        self.out_proj.load_state_dict(attn.out_proj.state_dict())
+        self.linear1 = layer.linear1
+        self.linear2 = layer.linear2
+        self.norm1 = layer.norm1
+        self.norm2 = layer.norm2
+
+    def forward(self, x: Tensor, k_buf: Tensor, v_buf: Tensor, past_len: int,
+                mask: Optional[Tensor]) -> Tensor:
+        """
+        :param x: Shape [new_len, batch_size, d_model]
+        :param k_buf: Keys of this layer, [batch_size, nhead, max_len, head_dim]; the new
+            positions are written at past_len.
+        """
+        seq_len, bsz, d_model = x.shape
+        head_dim = d_model // self.nhead
+        q, k, v = self.in_proj(x).chunk(3, dim=-1)
+        q = q.reshape(seq_len, bsz, self.nhead, head_dim).permute(1, 2, 0, 3)
+        k = k.reshape(seq_len, bsz, self.nhead, head_dim).permute(1, 2, 0, 3)
+        v = v.reshape(seq_len, bsz, self.nhead, head_dim).permute(1, 2, 0, 3)
+        total = past_len + seq_len
+        k_buf[:, :, past_len:total] = k
+        v_buf[:, :, past_len:total] = v
+
+        out = F.scaled_dot_product_attention(q, k_buf[:, :, :total], v_buf[:, :, :total], attn_mask=mask)
+        out = self.out_proj(out.permute(2, 0, 1, 3).reshape(seq_len, bsz, d_model))
+        x = self.norm1(x + out)
+        x = self.norm2(x + self.linear2(F.relu(self.linear1(x))))
+        return x
+
+
+class ExportModel(nn.Module):
+    """
+    Inference-only, scriptable equivalent of TransformerModel.forward_cached.
+    The cache is (keys, values, length), keys and values of shape
+    [nlayers, batch_size, nhead, max_len, head_dim].
+    """
+
+    def __init__(self, model: TransformerModel, max_len: int = MAX_LEN):
+        super().__init__()
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.scale = math.sqrt(model.d_model)
+        self.register_buffer("pe", model.pos_encoder.pe[:max_len, 0].clone())
+        self.layers = nn.ModuleList([ExportLayer(layer) for layer in model.transformer_encoder.layers])
+        self.nlayers = len(self.layers)
+        self.nhead = self.layers[0].nhead
+        self.head_dim = model.d_model // self.nhead
+        self.max_len = max_len
+
+    def forward(self, src: Tensor, src_mask: Optional[Tensor] = None) -> Tensor:
+        """
+        Whole sequence with causal masking (src_mask is ignored), like TransformerModel.forward.
+        """
+        return self.forward_cached(src, None, None)[0]
+
+    @torch.jit.export
+    def forward_cached(self, src: Tensor, cache: Optional[Tuple[Tensor, Tensor, int]] = None,
+                       pad: Optional[Tensor] = None) -> Tuple[Tensor, Tuple[Tensor, Tensor, int]]:
+        """
+        See TransformerModel.forward_cached.
+        """
+        seq_len, bsz = src.shape
+        if cache is None:
+            shape = [self.nlayers, bsz, self.nhead, self.max_len, self.head_dim]
+            k_cache = torch.zeros(shape, dtype=self.pe.dtype, device=src.device)
+            v_cache = torch.zeros(shape, dtype=self.pe.dtype, device=src.device)
+            past_len = 0
+        else:
+            k_cache, v_cache, past_len = cache
+        total = past_len + seq_len
+        if total > self.max_len:
+            raise ValueError("Sequence longer than max_len of the exported model")
+
+        positions = torch.arange(past_len, total, device=src.device).unsqueeze(1)
+        if pad is not None:
+            positions = positions - pad
+        x = self.encoder(src) * self.scale + self.pe[positions.clamp(min=0).expand(seq_len, bsz)]
+
+        mask: Optional[Tensor] = None
+        if seq_len > 1 or pad is not None:
+            keys = torch.arange(total, device=src.device)
+            queries = torch.arange(past_len, total, device=src.device).unsqueeze(1)
+            mask = keys <= queries
+            if pad is not None:
+                mask = mask & ((keys >= pad.view(-1, 1, 1)) | (keys == queries))
+                mask = mask.unsqueeze(1)
+
+        i = 0
+        for layer in self.layers:
+            x = layer(x, k_cache[i], v_cache[i], past_len, mask)
+            i += 1
+        return self.decoder(x), (k_cache, v_cache, total)
+
+
+def export(model: TransformerModel, path: str, max_len: int = MAX_LEN) -> torch.jit.ScriptModule:
+    script = torch.jit.script(ExportModel(model, max_len).eval())
+    script.save(path)
+    return script
+
+
+def check_parity(model: TransformerModel, script, steps: int = 8, tol: float = 1e-4) -> float:
+    """
+    Compare logits of the eager model and the exported graph, for a left padded batch
+    (prefill, then single token steps).
+    :return: Max absolute difference. Raises if above tol.
+    """
+    lens = [24, 9, 1]
+    src = torch.randint(1, 128, (max(lens), len(lens)))
+    pad = torch.tensor([max(lens) - n for n in lens])
+    for i, n in enumerate(lens):
+        src[:max(lens) - n, i] = 0
+
+    diff = 0.
+    with torch.no_grad():
+        for use_pad in (None, pad):
+            a, cache_a = model.forward_cached(src, None, use_pad)
+            b, cache_b = script.forward_cached(src, None, use_pad)
+            diff = max(diff, (a - b).abs().max().item())
+            for _ in range(steps):
+                tok = a[-1].argmax(dim=-1, keepdim=True).t()
+                a, cache_a = model.forward_cached(tok, cache_a, use_pad)
+                b, cache_b = script.forward_cached(tok, cache_b, use_pad)
+                diff = max(diff, (a - b).abs().max().item())
+    if diff > tol:
+        raise AssertionError(f"Exported graph differs from the eager model by {diff}")
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a model as a TorchScript graph")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--out", default="results/model.ts")
+    parser.add_argument("--nhead", type=int, default=4, help="Must match training")
+    parser.add_argument("--max-len", type=int, default=MAX_LEN, help="Max prompt + generated tokens")
+    args = parser.parse_args()
+
+    model = load_model(args.model, torch.device("cpu"), args.nhead)
+    export(model, args.out, args.max_len)
+    script = torch.jit.load(args.out)
+    print("Saved", args.out)
+    print(f"Parity with eager: max abs diff {check_parity(model, script):.2e}")
+    for batch_size in (1, 8):
+        a, b = time_generation(model, batch_size), time_generation(script, batch_size)
+        print(f"batch {batch_size}: eager {a:.2f} ms/token, exported {b:.2f} ms/token")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Evaluation metrics: confusion matrix, top-k accuracy and per-token loss.
+
+Everything is accumulated on the device with batched ops; nothing is copied to the
+host until the results are read, so evaluation doesn't stall on every batch.
+"""
+
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch import Tensor
+
+TOPK = (1, 5)
+
+
+class Metrics:
+    """
+    Accumulates over eval batches. Loss is plain cross entropy (no label smoothing),
+    so it stays comparable across runs.
+    """
+
+    def __init__(self, ntokens: int = 128, topk=TOPK, device=None):
+        self.ntokens = ntokens
+        self.topk = tuple(topk)
+        # confusion[actual, pred], flattened
+        self.confusion = torch.zeros(ntokens * ntokens, dtype=torch.long, device=device)
+        # Sum of losses by actual token
+        self.token_loss = torch.zeros(ntokens, dtype=torch.float64, device=device)
+        self.topk_correct = torch.zeros(len(self.topk), dtype=torch.long, device=device)
+
+    def update(self, output: Tensor, targets: Tensor):
+        """
+        :param output: Logits, shape [N, ntokens]
+        :param targets: Class indices, shape [N]
+        """
+        output = output.float()
+        loss = F.cross_entropy(output, targets, reduction="none")
+        self.token_loss.index_add_(0, targets, loss.double())
+
+        top = output.topk(max(self.topk), dim=-1).indices
+        self.confusion += torch.bincount(targets * self.ntokens + top[:, 0],
+                                         minlength=self.ntokens ** 2)
+        hits = (top == targets.unsqueeze(1)).cumsum(dim=1)
+        self.topk_correct += torch.stack([hits[:, k-1].sum() for k in self.topk])
+
+    def all_reduce(self):
+        """
+        Sum over all ranks of the process group.
+        """
+        for t in (self.confusion, self.token_loss, self.topk_correct):
+            dist.all_reduce(t)
+
+    def matrix(self) -> np.ndarray:
+        """
+        :return: Confusion matrix [actual, pred], shape [ntokens, ntokens]
+        """
+        return self.confusion.view(self.ntokens, self.ntokens).cpu().numpy()
+
+    @property
+    def count(self) -> int:
+        return int(self.confusion.sum())
+
+    @property
+    def loss(self) -> float:
+        return self.token_loss.sum().item() / max(self.count, 1)
+
+    def summary(self):
+        """
+        :return: Dict of scalar metrics. silence is the fraction of targets that are
+            token 0, silence_pred the fraction of predictions that are.
+        """
+        matrix = self.matrix()
+        count = max(matrix.sum(), 1)
+        summary = {"loss": self.loss}
+        for k, correct in zip(self.topk, self.topk_correct.tolist()):
+            summary[f"top{k}"] = correct / count
+        summary["silence"] = matrix[0].sum() / count
+        summary["silence_pred"] = matrix[:, 0].sum() / count
+        return summary
+
+    def save(self, dir: str):
+        """
+        Write confusion_matrix.npy and token_metrics.csv (one row per token) to dir.
+        """
+        matrix = self.matrix()
+        np.save(os.path.join(dir, "confusion_matrix.npy"), matrix)
+        count = matrix.sum(axis=1)
+        loss = self.token_loss.cpu().numpy()
+        with open(os.path.join(dir, "token_metrics.csv"), "w") as f:
+            f.write("token,count,predicted,accuracy,loss\n")
+            for tok in range(self.ntokens):
+                n = max(count[tok], 1)
+                f.write(f"{tok},{count[tok]},{matrix[:, tok].sum()},"
+                        f"{matrix[tok, tok] / n},{loss[tok] / n}\n")
@@ -2,58 +2,142 @@
 Utilities for integrating MIDI and transformer.
 """
 
+import hashlib
+import json
 import os
-from multiprocessing import Process
+import signal
+from multiprocessing import Pool
+from typing import Optional
 
 import mido
-import torch
+import numpy as np
 from tqdm import tqdm
 
+from dataset import ShardWriter, TokenStream, open_dataset, write_index
+
 DT = 0.12
-THREADS = 32
-TMPDIR = "/tmp/PianoML"
-os.makedirs(TMPDIR, exist_ok=True)
-
-
-def get_dataset_worker(jobs, dt):
-    for file in jobs:
-        mid = mido.MidiFile(file)
-        try:
-            tokens = tokenize_midi(mid, dt)
-        except Exception as e:
-            print(f"Error processing {file}: {e}")
-            continue
-        tokens = torch.tensor(tokens, dtype=torch.uint8)
-        out_file = os.path.join(TMPDIR, os.path.basename(file))
-        torch.save(tokens, out_file)
-
-def get_dataset(dir: str, dt: float = DT) -> torch.Tensor:
+# Files per task sent to a worker. Small, so that slow files don't hold up others.
+CHUNKSIZE = 4
+MANIFEST = "manifest.json"
+
+
+def init_worker():
+    # Ctrl-C is handled by the parent, which terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def tokenize_file(job):
+    """
+    Pool task.
+    :param job: (path, key, dt, max_consec)
+    :return: (path, key, tokens, error). tokens is None if there was an error.
+    """
+    path, key, dt, max_consec = job
+    try:
+        tokens = tokenize_midi(mido.MidiFile(path), dt, max_consec)
+    except Exception as e:
+        return path, key, None, f"{type(e).__name__}: {e}"
+    return path, key, tokens, None
+
+def file_key(path: str, params) -> str:
+    """
+    Hash of the file contents and tokenizer parameters.
+    """
+    h = hashlib.sha1(json.dumps(params).encode())
+    with open(path, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def get_dataset(dir: str, out_dir: str, dt: float = DT, max_consec: int = 2,
+                workers: Optional[int] = None) -> TokenStream:
+    """
+    Tokenize all MIDI files in dir into the dataset in out_dir (see dataset.py).
+
+    Incremental: out_dir/manifest.json maps each file's key (hash of contents and
+    tokenizer parameters) to its segment. Only files whose key is not in the manifest
+    are tokenized; the rest reuse their segments. Shards no longer referenced are deleted.
+
+    :param workers: Number of processes; defaults to the number of cores.
+    """
+    params = {"dt": dt, "intervals": INTERVALS, "max_consec": max_consec}
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
     files = []
-    for file in os.listdir(dir):
+    for file in sorted(os.listdir(dir)):
         if file.endswith(".mid"):
-            files.append(os.path.join("data", file))
+            path = os.path.join(dir, file)
+            files.append((path, file_key(path, params)))
+    jobs = list({key: (path, key) for path, key in files if key not in manifest}.values())
+    print(f"{len(files)} files, {len(files) - len(jobs)} unchanged")
 
-    threads = []
-    for i in range(THREADS):
-        t = Process(target=get_dataset_worker, args=(files[i::THREADS], dt))
-        threads.append(t)
-        t.start()
+    if jobs:
+        errors = []
+        jobs = [(path, key, dt, max_consec) for path, key in jobs]
+        pbar = tqdm(total=len(jobs), desc="Processing MIDI")
+        # Results are streamed into shards as workers finish them, in any order;
+        # the whole dataset is never in memory.
+        with Pool(workers, initializer=init_worker) as pool, ShardWriter(out_dir) as writer:
+            try:
+                for path, key, tokens, error in pool.imap_unordered(tokenize_file, jobs, CHUNKSIZE):
+                    if error is None:
+                        manifest[key] = writer.write(tokens)
+                    else:
+                        errors.append(path)
+                        pbar.write(f"Error processing {path}: {error}")
+                    pbar.update()
+            except KeyboardInterrupt:
+                pool.terminate()
+                pbar.write("KeyboardInterrupt; keeping data processed so far...")
+        pbar.close()
+        if errors:
+            print(f"{len(errors)} files failed")
 
-    pbar = tqdm(total=len(files), desc="Processing MIDI")
-    try:
-        while any(t.is_alive() for t in threads):
-            num_done = len(os.listdir(TMPDIR))
-            pbar.update(num_done - pbar.n)
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-        print("KeyboardInterrupt; compiling current data...")
-    pbar.close()
+    # Files which failed to tokenize have no segment.
+    manifest = {key: manifest[key] for path, key in files if key in manifest}
+    write_index(out_dir, [manifest[key] for path, key in files if key in manifest])
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    used = {segment[0] for segment in manifest.values()}
+    for file in os.listdir(out_dir):
+        if file.endswith(".bin") and file not in used:
+            os.remove(os.path.join(out_dir, file))
+
+    return open_dataset(out_dir)
 
-    all_data = []
-    for file in os.listdir(TMPDIR):
-        all_data.append(torch.load(os.path.join(TMPDIR, file)))
-    return torch.cat(all_data)
+
+INTERVALS = (
+    (0, 31),
+    (16, 47),
+    (32, 63),
+    (48, 79),
+    (64, 95),
+    (80, 111),
+    (96, 127),
+)
+
+
+def read_note_ons(midi: mido.MidiFile):
+    """
+    Parse midi once into arrays.
+
+    :return: (times, notes, end_time). Times (seconds) and notes of note on messages,
+        and the length of the piece.
+    """
+    times = []
+    notes = []
+    time = 0
+    for msg in midi:
+        time += msg.time
+        if msg.type == "note_on":
+            times.append(time)
+            notes.append(msg.note)
+    return np.array(times, dtype=np.float64), np.array(notes, dtype=np.uint8), time
 
 
 def tokenize_interval(midi: mido.MidiFile, interval, dt: float = DT):
@@ -67,55 +151,90 @@ def tokenize_interval(midi: mido.MidiFile, interval, dt: float = DT):
     1-127: Note x on
 
     :param interval: tuple[int, int]. To make it sane, only consider notes within interval.
+    :return: np.ndarray of uint8 tokens.
     """
-    messages = []
-    time = 0
-    for msg in midi:
-        time += msg.time
-        if msg.type == "note_on":
-            if interval[0] <= msg.note <= interval[1]:
-                messages.append((time, msg.note))
+    times, notes, end_time = read_note_ons(midi)
+    return tokenize_messages(times, notes, end_time, dt, [interval])[0]
+
+def tokenize_messages(times, notes, end_time: float, dt: float = DT, intervals=((0, 127),)):
+    """
+    Token logic of tokenize_interval, for several intervals at once.
+    A message goes to the first time step at or after it.
 
-    tokens = [0] * int(time/dt + 1)
-    ptr = 0
-    for i in range(len(tokens)):
-        time = i * dt
-        while ptr < len(messages) and messages[ptr][0] <= time:
-            tokens[i] = max(tokens[i], messages[ptr][1])
-            ptr += 1
+    :param times: Times of note on messages, sorted.
+    :param notes: Notes of note on messages.
+    :param end_time: Length of the piece in seconds.
+    :return: List of np.ndarray of uint8 tokens, one per interval.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    notes = np.asarray(notes, dtype=np.uint8)
+    steps = np.arange(int(end_time/dt + 1)) * dt
+    # Messages after the last step are dropped.
+    idx = np.searchsorted(steps, times, side="left")
+    valid = idx < len(steps)
 
-    return tokens
+    all_tokens = []
+    for low, high in intervals:
+        mask = valid & (low <= notes) & (notes <= high)
+        tokens = np.zeros(len(steps), dtype=np.uint8)
+        np.maximum.at(tokens, idx[mask], notes[mask])
+        all_tokens.append(tokens)
+    return all_tokens
 
 def filter_tokens(tokens, max_consec=2):
     """
     Remove consecutive zeros that are too long.
     """
-    new_tokens = []
-    consec = 0
-    for token in tokens:
-        if token == 0:
-            consec += 1
-            if consec <= max_consec:
-                new_tokens.append(token)
-        else:
-            consec = 0
-            new_tokens.append(token)
-    return new_tokens
-
-def tokenize_midi(midi, dt: float = DT):
-    intervals = (
-        (0, 31),
-        (16, 47),
-        (32, 63),
-        (48, 79),
-        (64, 95),
-        (80, 111),
-        (96, 127),
-    )
-    tokens = []
-    for i in intervals:
-        tokens += filter_tokens(tokenize_interval(midi, i, dt))
-    return tokens
+    tokens = np.asarray(tokens)
+    zero = tokens == 0
+    # Length of the zero run so far, at each position.
+    consec = np.cumsum(zero)
+    consec -= np.maximum.accumulate(np.where(zero, 0, consec))
+    return tokens[~zero | (consec <= max_consec)]
+
+def tokenize_midi(midi, dt: float = DT, max_consec: int = 2):
+    times, notes, end_time = read_note_ons(midi)
+    tokens = tokenize_messages(times, notes, end_time, dt, INTERVALS)
+    return np.concatenate([filter_tokens(t, max_consec) for t in tokens])
+
+
+def notes_to_tokens(notes, dt: float = DT):
+    """
+    Tokenize notes directly, without going through a MIDI file.
+    Same as tokenize_interval(events_to_midi(...), (0, 127)): time starts at the
+    first note, but without tick rounding.
+
+    :param notes: List of (note, start, end), or a structured array with fields note,
+        start and end (e.g. net.NOTE), whose columns are used without conversion.
+    """
+    if isinstance(notes, np.ndarray) and notes.dtype.names is not None:
+        pitches, starts, ends = notes["note"], notes["start"], notes["end"]
+    else:
+        notes = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+        pitches, starts, ends = notes[:, 0], notes[:, 1], notes[:, 2]
+    if len(starts) == 0:
+        return tokenize_messages([], [], 0, dt)[0]
+    t0 = starts.min()
+    end_time = max(starts.max(), ends.max()) - t0
+    keep = pitches.astype(int) != 0
+    pitches, starts = pitches[keep], starts[keep]
+    order = np.argsort(starts, kind="stable")
+    return tokenize_messages(starts[order] - t0, pitches[order], end_time, dt)[0]
+
+def token_to_note(token, i: int, dt: float = DT):
+    """
+    Note of the i-th token, as in tokens_to_notes.
+    :return: (note, start, end), or None for silence (token 0).
+    """
+    return (int(token), i*dt, (i+1)*dt) if token != 0 else None
+
+def tokens_to_notes(tokens, dt: float = DT):
+    """
+    Inverse of notes_to_tokens: each non zero token is a note lasting dt.
+
+    :return: List of (note, start, end)
+    """
+    return [token_to_note(tok, i, dt) for i, tok in enumerate(tokens) if tok != 0]
 
 
 def events_to_midi(events):
@@ -136,5 +255,6 @@ def events_to_midi(events):
 
 
 if __name__ == "__main__":
-    data = get_dataset("data", 0.12)
-    torch.save(data, "results/all_data.pt")
+    from cache import DatasetCache
+    data = DatasetCache().get("data", DT)
+    print("MIDI:", len(data), "tokens")
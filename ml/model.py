@@ -1,83 +1,111 @@
+"""
+Training. Nothing is loaded at import; run as a script, or build a Trainer from a Config.
+
+python model.py --dt 0.25 --netsize 512
+"""
+
 import argparse
+import json
 import math
 import os
-from tempfile import TemporaryDirectory
-from typing import Tuple
+import random
+import time
+from contextlib import ExitStack, nullcontext
+from dataclasses import asdict, dataclass, fields, replace
+from typing import Optional, Tuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch import nn, Tensor
 import torch.nn.functional as F
-from torch.nn import TransformerEncoder, TransformerEncoderLayer
-from torch.utils.data import dataset
-
-confusion_matrix = np.zeros((128, 128), dtype=int)
-
+from torch.nn.parallel import DistributedDataParallel
 
-class TransformerModel(nn.Module):
+from cache import CACHE_DIR, DatasetCache
+from dataset import TokenStream, WindowSampler, load_tokens
+from metrics import TOPK, Metrics
+from midi import DT
+from profiling import PHASES, StepStats, make_profiler
+from transformer import TransformerModel, generate_square_subsequent_mask
 
-    def __init__(self, ntoken: int, d_model: int, nhead: int, d_hid: int,
-                 nlayers: int, dropout: float = 0.5):
-        super().__init__()
-        self.model_type = 'Transformer'
-        self.pos_encoder = PositionalEncoding(d_model, dropout)
-        encoder_layers = TransformerEncoderLayer(d_model, nhead, d_hid, dropout)
-        self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
-        self.encoder = nn.Embedding(ntoken, d_model)
-        self.d_model = d_model
-        self.decoder = nn.Linear(d_model, ntoken)
-
-        self.init_weights()
-
-    def init_weights(self) -> None:
-        initrange = 0.1
-        self.encoder.weight.data.uniform_(-initrange, initrange)
-        self.decoder.bias.data.zero_()
-        self.decoder.weight.data.uniform_(-initrange, initrange)
-
-    def forward(self, src: Tensor, src_mask: Tensor) -> Tensor:
-        """
-        Args:
-            src: Tensor, shape [seq_len, batch_size]
-            src_mask: Tensor, shape [seq_len, seq_len]
 
-        Returns:
-            output Tensor of shape [seq_len, batch_size, ntoken]
-        """
-        src = self.encoder(src) * math.sqrt(self.d_model)
-        src = self.pos_encoder(src)
-        output = self.transformer_encoder(src, src_mask)
-        output = self.decoder(output)
-        return output
-
-
-def generate_square_subsequent_mask(sz: int) -> Tensor:
-    """Generates an upper-triangular matrix of -inf, with zeros on diag."""
-    return torch.triu(torch.ones(sz, sz) * float('-inf'), diagonal=1)
-
-
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
-        super().__init__()
-        self.dropout = nn.Dropout(p=dropout)
-
-        position = torch.arange(max_len).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(max_len, 1, d_model)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
-        self.register_buffer('pe', pe)
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    def forward(self, x: Tensor) -> Tensor:
+# Mixed precision modes for Config.amp
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+@dataclass
+class Config:
+    # Data
+    dt: float = DT  # tokenizer time step
+    data: Optional[str] = None  # dataset dir; defaults to the cached one for midi_dir and dt
+    midi_dir: str = "data"  # MIDI files to build the dataset from
+    cache_dir: str = CACHE_DIR  # tokenized datasets, see cache.py
+    cache_gb: float = 10.0  # disk budget of the cache; least recently used datasets are deleted
+    results: str = "results"  # logs and models are written here
+
+    # Model
+    ntokens: int = 128  # size of vocabulary
+    emsize: int = 1024  # embedding dimension, and relational database dimensionality
+    d_hid: int = 1024  # dimension of the feedforward network model in nn.TransformerEncoder
+    nlayers: int = 8  # number of nn.TransformerEncoderLayer in nn.TransformerEncoder
+    nhead: int = 4  # number of heads in nn.MultiheadAttention
+    dropout: float = 0.1  # dropout probability
+
+    # Training
+    batch_size: int = 64  # per micro-batch and rank
+    accum_steps: int = 1  # micro-batches of gradient accumulated per optimizer step
+    checkpoint_layers: bool = False  # recompute encoder layer activations in backward, to save memory
+    eval_batch_size: int = 32
+    bptt: int = 64
+    epochs: int = 50
+    patience: int = 0  # stop after this many epochs without a better validation loss; 0 for never
+    steps_per_epoch: int = 0  # batches per epoch; 0 for as many tokens as the train split
+    num_workers: int = 2  # background processes preparing batches
+    seed: int = 0
+    # Data parallel processes to start on this machine. For several machines, launch
+    # with torchrun instead, which sets the environment (RANK, WORLD_SIZE, MASTER_ADDR...).
+    world_size: int = 1
+    backend: str = "gloo"  # torch.distributed backend; gloo works on CPU only machines
+    lr: float = 1
+    gamma: float = 0.8  # StepLR decay per epoch
+    label_smoothing: float = 0.0  # e.g. 0.1; applied by the training loss only
+    amp: Optional[str] = None  # mixed precision: None (fp32) or a key of AMP_DTYPES
+    log_interval: int = 200  # optimizer steps between throughput reports
+    profile: int = 0  # steps to trace with torch.profiler (rank 0), after profile_wait; 0 for off
+    profile_wait: int = 5
+
+    # Checkpoints, in <results>/checkpoints
+    checkpoint_every: int = 1000  # batches between checkpoints (also saved every epoch); 0 for epochs only
+    keep_checkpoints: int = 3  # older ones are deleted
+    resume: Optional[str] = None  # checkpoint file to resume from, or "auto" for the latest
+
+    @classmethod
+    def from_args(cls, argv=None) -> "Config":
         """
-        Args:
-            x: Tensor, shape [seq_len, batch_size, embedding_dim]
+        Every field is a command line flag, e.g. --batch-size.
+        --netsize sets both emsize and d_hid.
         """
-        x = x + self.pe[:x.size(0)]
-        return self.dropout(x)
+        parser = argparse.ArgumentParser()
+        for field in fields(cls):
+            flag = "--" + field.name.replace("_", "-")
+            if field.name == "amp":
+                parser.add_argument(flag, choices=list(AMP_DTYPES), help="Mixed precision (bf16 on CPU)")
+            elif field.default is None:
+                parser.add_argument(flag, type=str)
+            elif isinstance(field.default, bool):
+                parser.add_argument(flag, action="store_true")
+            else:
+                parser.add_argument(flag, type=type(field.default), default=field.default)
+        parser.add_argument("--netsize", type=int, help="Sets emsize and d_hid")
+        args = vars(parser.parse_args(argv))
+        netsize = args.pop("netsize")
+        if netsize is not None:
+            args["emsize"] = args["d_hid"] = netsize
+        return cls(**args)
 
 
 class ScheduledOptim():
@@ -104,6 +132,12 @@ class ScheduledOptim():
         "Zero out the gradients with the inner optimizer"
         self._optimizer.zero_grad()
 
+    def state_dict(self):
+        return {"n_steps": self.n_steps}
+
+    def load_state_dict(self, state):
+        self.n_steps = state["n_steps"]
+
 
     def _get_lr_scale(self):
         d_model = self.d_model
@@ -121,240 +155,510 @@ class ScheduledOptim():
             param_group['lr'] = lr
 
 
-from torchtext.datasets import WikiText2
-from torchtext.data.utils import get_tokenizer
-from torchtext.vocab import build_vocab_from_iterator
-
-'''
-train_iter = WikiText2(split='train')
-tokenizer = get_tokenizer('basic_english')
-vocab = build_vocab_from_iterator(map(tokenizer, train_iter), specials=['<unk>'])
-vocab.set_default_index(vocab['<unk>'])
-#print(vocab["world"])
-
-def data_process(raw_text_iter: dataset.IterableDataset) -> Tensor:
-    """Converts raw text into a flat Tensor."""
-    data = [torch.tensor(vocab(tokenizer(item)), dtype=torch.long) for item in raw_text_iter]
-    return torch.cat(tuple(filter(lambda t: t.numel() > 0, data)))
-
-# train_iter was "consumed" by the process of building the vocab,
-# so we have to create it again
-train_iter, val_iter, test_iter = WikiText2()
-train_data = data_process(train_iter)
-val_data = data_process(val_iter)
-test_data = data_process(test_iter)
-'''
-
-from midi import get_dataset
-print("Loading midi data...")
-#all_data = torch.tensor(get_dataset("data", 0.12))
-#torch.save(all_data, "results/all_data.pt")
-if os.path.isfile("results/all_data.pt"):
-    all_data = torch.load("results/all_data.pt").long()
-else:
-    all_data = torch.tensor([0], dtype=torch.long)
-print("MIDI:", len(all_data), "tokens")
-#stop
-
-train_len = int(len(all_data) * 0.8)
-val_len = int(len(all_data) * 0.1)
-test_len = len(all_data) - train_len - val_len
-train_data = all_data[:train_len]
-val_data = all_data[train_len:train_len + val_len]
-test_data = all_data[train_len + val_len:]
+def load_data(cfg: Config) -> TokenStream:
+    """
+    Open the token dataset (memory mapped): cfg.data, or the cached dataset of
+    cfg.midi_dir tokenized with cfg.dt (see cache.py). An existing cache entry is
+    opened as is; use prepare_data first to update it.
+    """
+    path = cfg.data
+    if path is None:
+        cache = DatasetCache(cfg.cache_dir, cfg.cache_gb)
+        data = cache.open(cfg.midi_dir, cfg.dt)
+        if data is None:
+            data = cache.get(cfg.midi_dir, cfg.dt)
+        if data is not None:
+            return data
+        # Older versions saved a single tensor to results/all_data.pt
+        path = os.path.join(cfg.results, "all_data.pt")
+        if cfg.dt != DT:
+            path = None
+    if path is None or not os.path.exists(path):
+        print(f"No data for dt = {cfg.dt} at {path or cfg.midi_dir}")
+        return TokenStream([np.zeros(1, dtype=np.uint8)])
+    return load_tokens(path)
+
+def prepare_data(cfg: Config) -> Config:
+    """
+    Build or update the cached dataset of cfg.midi_dir, once before training starts,
+    so that training processes only open it.
+    :return: cfg with data set to the cache entry (unchanged if cfg.data is given, or
+        if there is no dataset).
+    """
+    if cfg.data is not None:
+        return cfg
+    cache = DatasetCache(cfg.cache_dir, cfg.cache_gb)
+    if cache.get(cfg.midi_dir, cfg.dt) is None:
+        return cfg
+    return replace(cfg, data=cache.path(cfg.midi_dir, cfg.dt))
+
+def split_data(data: TokenStream) -> Tuple[TokenStream, TokenStream, TokenStream]:
+    """
+    80/10/10 train/val/test split, without copying.
+    """
+    train_len = int(len(data) * 0.8)
+    val_len = int(len(data) * 0.1)
+    train_data = data.slice(0, train_len)
+    val_data = data.slice(train_len, train_len + val_len)
+    test_data = data.slice(train_len + val_len, len(data))
+    return train_data, val_data, test_data
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-def batchify(data: Tensor, bsz: int) -> Tensor:
+def atomic_save(obj, path: str):
+    """
+    torch.save that never leaves a partially written file at path.
+    """
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def latest_checkpoint(dir: str) -> Optional[str]:
+    if not os.path.isdir(dir):
+        return None
+    files = sorted(f for f in os.listdir(dir) if f.startswith("ckpt_") and f.endswith(".pt"))
+    return os.path.join(dir, files[-1]) if files else None
+
+def get_rng_state():
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class Batchified:
+    """
+    Token stream divided into bsz separate sequences (columns), removing extra elements
+    that wouldn't cleanly fit. Shape [N // bsz, bsz].
+    Rows are read from the stream when needed, instead of copying it all to the device.
+    """
+
+    def __init__(self, data: TokenStream, bsz: int):
+        self.data = data
+        self.bsz = bsz
+        self.seq_len = len(data) // bsz
+
+    def __len__(self):
+        return self.seq_len
+
+    def size(self, dim: int) -> int:
+        return (self.seq_len, self.bsz)[dim]
+
+    def rows(self, start: int, stop: int) -> Tensor:
+        """
+        Returns:
+            Tensor of shape [stop - start, bsz]
+        """
+        cols = [self.data[b*self.seq_len + start : b*self.seq_len + stop] for b in range(self.bsz)]
+        return torch.from_numpy(np.stack(cols, axis=1)).long().to(device)
+
+def batchify(data: TokenStream, bsz: int) -> Batchified:
     """Divides the data into bsz separate sequences, removing extra elements
     that wouldn't cleanly fit.
 
     Args:
-        data: Tensor, shape [N]
+        data: TokenStream, length N
         bsz: int, batch size
 
     Returns:
-        Tensor of shape [N // bsz, bsz]
+        Batchified of shape [N // bsz, bsz]
     """
-    seq_len = data.size(0) // bsz
-    data = data[:seq_len * bsz]
-    data = data.view(bsz, seq_len).t().contiguous()
-    return data.to(device)
-
-batch_size = 64
-eval_batch_size = 32
-train_data = batchify(train_data, batch_size)  # shape [seq_len, batch_size]
-val_data = batchify(val_data, eval_batch_size)
-test_data = batchify(test_data, eval_batch_size)
+    return Batchified(data, bsz)
 
 
-bptt = 64
-def get_batch(source: Tensor, i: int) -> Tuple[Tensor, Tensor]:
+def get_batch(source: Batchified, i: int, bptt: int) -> Tuple[Tensor, Tensor]:
     """
     Args:
-        source: Tensor, shape [full_seq_len, batch_size]
+        source: Batchified, shape [full_seq_len, batch_size]
         i: int
+        bptt: int, max sequence length
 
     Returns:
         tuple (data, target), where data has shape [seq_len, batch_size] and
-        target has shape [seq_len * batch_size]
+        target has shape [seq_len * batch_size], containing class indices
     """
     seq_len = min(bptt, len(source) - 1 - i)
-    data = source[i:i+seq_len]
-    target = source[i+1:i+1+seq_len].reshape(-1)
+    rows = source.rows(i, i+1+seq_len)
+    data = rows[:-1]
+    target = rows[1:].reshape(-1)
+    return data, target
 
-    # Target contains actual tokens; now we one-hot encode it
-    target = torch.nn.functional.one_hot(target, num_classes=ntokens).float()
-    # Smoothing
-    #target = target * (1 - label_smoothing) + label_smoothing / ntokens
 
-    return data, target
+def build_model(cfg: Config) -> TransformerModel:
+    return TransformerModel(cfg.ntokens, cfg.emsize, cfg.nhead, cfg.d_hid, cfg.nlayers, cfg.dropout).to(device)
 
 
-#ntokens = len(vocab)  # size of vocabulary
-ntokens = 128
-emsize = 1024  # embedding dimension, and relational database dimensionality
-d_hid = 1024  # dimension of the feedforward network model in nn.TransformerEncoder
-nlayers = 8  # number of nn.TransformerEncoderLayer in nn.TransformerEncoder
-nhead = 4  # number of heads in nn.MultiheadAttention
-dropout = 0.1  # dropout probability
-#label_smoothing = 0.1
-model = TransformerModel(ntokens, emsize, nhead, d_hid, nlayers, dropout).to(device)
+class Trainer:
+    """
+    Model, data and optimizer state of one training run.
+    """
 
+    def __init__(self, cfg: Config, rank: int = 0, world_size: int = 1):
+        """
+        With world_size > 1, the process group must be initialized (see run).
+        Each rank trains on its own shard of the train split, gradients are averaged,
+        and only rank 0 logs and saves.
+        """
+        self.cfg = cfg
+        self.rank = rank
+        self.world_size = world_size
+        self.distributed = world_size > 1
+        torch.manual_seed(cfg.seed)
+
+        self.log("Loading midi data...")
+        all_data = load_data(cfg)
+        self.log("MIDI:", len(all_data), "tokens")
+        train_data, val_data, test_data = (self.shard(d) for d in split_data(all_data))
+        # Training draws shuffled random-offset windows; evaluation walks the data in order.
+        # steps_per_epoch counts optimizer steps; the sampler yields micro-batches.
+        steps = cfg.steps_per_epoch or max(len(train_data) // (cfg.bptt * cfg.batch_size * cfg.accum_steps), 1)
+        self.sampler = WindowSampler(train_data, cfg.bptt, cfg.batch_size, steps * cfg.accum_steps,
+                                     cfg.seed, rank)
+        # Own generator: starting an epoch must not draw from the global RNG, or resuming
+        # mid-epoch would shift the dropout masks.
+        self.loader = torch.utils.data.DataLoader(
+            self.sampler, batch_size=None, num_workers=cfg.num_workers,
+            pin_memory=device.type == "cuda", generator=torch.Generator().manual_seed(cfg.seed))
+        self.val_data = batchify(val_data, cfg.eval_batch_size)
+        self.test_data = batchify(test_data, cfg.eval_batch_size)
+
+        # Same seed on every rank, so the initial weights match.
+        self.model = build_model(cfg)
+        self.model.checkpoint_layers = cfg.checkpoint_layers
+        self.train_model = self.model
+        if self.distributed:
+            self.train_model = DistributedDataParallel(self.model)
+        self.criterion = nn.CrossEntropyLoss(label_smoothing=cfg.label_smoothing)
+        # Copying "Attention is all you need"
+        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=cfg.lr)
+        #self.scheduler = ScheduledOptim(self.optimizer, 15, cfg.emsize, 4000)
+        self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, 1, gamma=cfg.gamma)
+
+        self.amp_dtype = None if cfg.amp is None else AMP_DTYPES[cfg.amp]
+        # Loss scaling is only needed for fp16; a no-op otherwise.
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.amp_dtype == torch.float16)
+
+        self.curr_batch_num = 0
+        self.profiler = None
+        self.bad_epochs = 0
+
+    def log(self, *args):
+        if self.rank == 0:
+            print(*args)
+
+    def shard(self, data: TokenStream) -> TokenStream:
+        """
+        This rank's disjoint part of data.
+        """
+        size = len(data) // self.world_size
+        return data.slice(self.rank * size, (self.rank + 1) * size)
 
-import copy
-import time
+    def autocast(self):
+        """Autocast context for forward passes. Weights stay fp32."""
+        return torch.autocast(device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
 
-criterion = nn.CrossEntropyLoss()
-# Copying "Attention is all you need"
-optimizer = torch.optim.SGD(model.parameters(), lr=1)
-#scheduler = ScheduledOptim(optimizer, 15, emsize, 4000)
-scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 1, gamma=0.8)
-epochs = 50
-
-curr_batch_num = 0
-
-
-def train(model: nn.Module, epoch) -> None:
-    global curr_batch_num
-
-    model.train()  # turn on train mode
-    total_loss = 0.
-    log_interval = 200
-    start_time = time.time()
-    src_mask = generate_square_subsequent_mask(bptt).to(device)
-
-    num_batches = len(train_data) // bptt
-    for batch, i in enumerate(range(0, train_data.size(0) - 1, bptt)):
-        data, targets = get_batch(train_data, i)
-        seq_len = data.size(0)
-        if seq_len != bptt:  # only on last batch
-            src_mask = src_mask[:seq_len, :seq_len]
-        output = model(data, src_mask)
-        loss = criterion(output.view(-1, ntokens), targets)
-
-        optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-        optimizer.step()
-        #scheduler.step_and_update_lr()
-
-        if curr_batch_num >= 3:
-            logtrain.write(f"{loss.item()},{scheduler.get_last_lr()[0]}\n")
-        curr_batch_num += 1
-
-        total_loss += loss.item()
-        if batch % log_interval == 0 and batch > 0:
-            lr = scheduler.get_last_lr()[0]
-            ms_per_batch = (time.time() - start_time) * 1000 / log_interval
-            cur_loss = total_loss / log_interval
-            ppl = math.exp(cur_loss)
-            print(f'| epoch {epoch:3d} | {batch:5d}/{num_batches:5d} batches | '
-                  f'lr {lr:.6f} | ms/batch {ms_per_batch:5.2f} | '
-                  f'loss {cur_loss:5.2f} | ppl {ppl:8.2f}')
-            total_loss = 0
-            start_time = time.time()
-
-def evaluate(model: nn.Module, eval_data: Tensor) -> float:
-    model.eval()  # turn on evaluation mode
-    total_loss = 0.
-    src_mask = generate_square_subsequent_mask(bptt).to(device)
-    with torch.no_grad():
-        for i in range(0, eval_data.size(0) - 1, bptt):
-            data, targets = get_batch(eval_data, i)
-            seq_len = data.size(0)
-            if seq_len != bptt:
-                src_mask = src_mask[:seq_len, :seq_len]
-            output = model(data, src_mask)
-            output_flat = output.view(-1, ntokens)
-            total_loss += seq_len * criterion(output_flat, targets).item()
-
-            # Update confusion matrix
-            """
-            for j in range(output_flat.size(0)):
-                pred = output_flat[j].argmax().item()
-                actual = targets[j].item()
-                confusion_matrix[actual, pred] += 1
-            """
-
-    return total_loss / (len(eval_data) - 1)
-
-
-def main_training_loop():
-    best_val_loss = float('inf')
-
-    with TemporaryDirectory() as tempdir:
-        best_model_params_path = os.path.join(tempdir, "best_model_params.pt")
-
-        print("Training start.")
-        num_params = sum(p.numel() for p in model.parameters())
-        print(f"Number of learnable parameters: {num_params}")
-        #print("Resuming from results/model.pt")
-        #model.load_state_dict(torch.load("results/model.pt"))
+    def train(self, epoch, logtrain, logperf, start_batch: int = 0,
+              best_val_loss: float = float('inf')) -> None:
+        """
+        Gradients of accum_steps consecutive micro-batches are summed before each
+        optimizer step. Batch numbers count micro-batches.
 
-        for epoch in range(1, epochs + 1):
-            confusion_matrix.fill(0)
+        Every log_interval steps (and at the end), the loss and lr of each step are
+        written to logtrain, and throughput to logperf (one JSON object per line).
 
+        :param start_batch: Skip the first batches of the epoch (when resuming).
+        :param best_val_loss: Stored in checkpoints.
+        """
+        model = self.train_model
+        bptt = self.cfg.bptt
+        ntokens = self.cfg.ntokens
+        accum = self.cfg.accum_steps
+
+        model.train()  # turn on train mode
+        stats = StepStats(device, bptt * self.cfg.batch_size * accum)
+        step_loss = 0.
+        src_mask = generate_square_subsequent_mask(bptt).to(device)
+
+        self.sampler.set_epoch(epoch, start_batch)
+        num_batches = len(self.sampler)
+        self.optimizer.zero_grad()
+        loader = iter(self.loader)
+        for batch in range(start_batch, num_batches):
+            with stats.phase("data"):
+                window = next(loader).to(device, non_blocking=True)
+            data = window[:-1]
+            targets = window[1:].reshape(-1)
+            last = (batch + 1) % accum == 0
+            # DDP would all-reduce the gradients of every backward; only the last one is needed.
+            sync = nullcontext() if last or not self.distributed else model.no_sync()
+            with sync:
+                with stats.phase("forward"), self.autocast():
+                    output = model(data, src_mask)
+                    loss = self.criterion(output.view(-1, ntokens), targets)
+                with stats.phase("backward"):
+                    self.scaler.scale(loss / accum).backward()
+            step_loss = step_loss + loss.detach()
+            if not last:
+                continue
+
+            with stats.phase("optimizer"):
+                self.scaler.unscale_(self.optimizer)  # so that clipping sees the real gradients
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
+                #self.scheduler.step_and_update_lr()
+            stats.step(step_loss / accum, self.scheduler.get_last_lr()[0])
+            step_loss = 0.
+            if self.profiler is not None:
+                self.profiler.step()
+
+            step = (batch + 1) // accum  # optimizer steps this epoch
+            if step % self.cfg.log_interval == 0 or batch + 1 == num_batches:
+                self.log_steps(epoch, step, num_batches // accum, stats, logtrain, logperf)
+
+            every = self.cfg.checkpoint_every
+            if every > 0 and step % every == 0 and batch + 1 < num_batches:
+                self.save_checkpoint(epoch, batch + 1, best_val_loss)
+
+    def log_steps(self, epoch, step, num_steps, stats: StepStats, logtrain, logperf):
+        """
+        Write out and reset stats; step is the last step of the epoch they cover.
+        """
+        losses, lrs, record = stats.summary()
+        first = step - len(losses) + 1
+        for i, (loss, lr) in enumerate(zip(losses, lrs)):
+            if self.curr_batch_num >= 3:
+                logtrain.write(f"{epoch},{first + i},{loss},{lr}\n")
+            self.curr_batch_num += 1
+        logperf.write(json.dumps({"epoch": epoch, "step": step, **record}) + "\n")
+
+        phases = " ".join(f"{name} {record[name + '_ms']:.1f}" for name in PHASES)
+        self.log(f'| epoch {epoch:3d} | {step:5d}/{num_steps:5d} steps | '
+              f'lr {lrs[-1]:.6f} | ms/step {record["ms_per_step"]:5.2f} ({phases}) | '
+              f'tok/s {record["tokens_per_sec"]:7.0f} | mem {record["peak_mem_mb"]:.0f}MB | '
+              f'loss {record["loss"]:5.2f} | ppl {math.exp(record["loss"]):8.2f}')
+
+    def evaluate(self, eval_data: Batchified) -> Metrics:
+        model = self.model
+        bptt = self.cfg.bptt
+
+        model.eval()  # turn on evaluation mode
+        metrics = Metrics(self.cfg.ntokens, device=device)
+        src_mask = generate_square_subsequent_mask(bptt).to(device)
+        with torch.no_grad():
+            for i in range(0, eval_data.size(0) - 1, bptt):
+                data, targets = get_batch(eval_data, i, bptt)
+                seq_len = data.size(0)
+                if seq_len != bptt:
+                    src_mask = src_mask[:seq_len, :seq_len]
+                with self.autocast():
+                    output = model(data, src_mask)
+                metrics.update(output.view(-1, self.cfg.ntokens), targets)
+
+        if self.distributed:
+            # Every rank gets the loss over all shards, so they agree on the best model.
+            metrics.all_reduce()
+        return metrics
+
+    def save_checkpoint(self, epoch: int, batch: int, best_val_loss: float):
+        """
+        Save everything needed to continue training at batch of epoch.
+        Called on every rank (for the RNG states); rank 0 writes.
+        """
+        rng = [get_rng_state()]
+        if self.distributed:
+            rng = [None] * self.world_size
+            dist.all_gather_object(rng, get_rng_state())
+        if self.rank != 0:
+            return
+
+        dir = os.path.join(self.cfg.results, "checkpoints")
+        os.makedirs(dir, exist_ok=True)
+        path = os.path.join(dir, f"ckpt_{epoch:04d}_{batch:07d}.pt")
+        atomic_save({
+            "config": asdict(self.cfg),
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "epoch": epoch,
+            "batch": batch,
+            "curr_batch_num": self.curr_batch_num,
+            "best_val_loss": best_val_loss,
+            "bad_epochs": self.bad_epochs,
+            "rng": rng,
+        }, path)
+
+        files = sorted(f for f in os.listdir(dir) if f.startswith("ckpt_") and f.endswith(".pt"))
+        for f in files[:-self.cfg.keep_checkpoints]:
+            os.remove(os.path.join(dir, f))
+
+    def load_checkpoint(self, path: str):
+        """
+        :return: (epoch, batch, best_val_loss) to continue from.
+        """
+        state = torch.load(path, map_location=device, weights_only=False)
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.scheduler.load_state_dict(state["scheduler"])
+        self.scaler.load_state_dict(state["scaler"])
+        self.curr_batch_num = state["curr_batch_num"]
+        self.bad_epochs = state.get("bad_epochs", 0)
+        rng = state["rng"]
+        set_rng_state(rng[self.rank] if len(rng) == self.world_size else rng[0])
+        return state["epoch"], state["batch"], state["best_val_loss"]
+
+    def should_stop(self, epoch: int, val_loss: float, best_val_loss: float) -> bool:
+        """
+        Called after each epoch (on every rank, with the same losses) to stop training early.
+        :param best_val_loss: Best before this epoch.
+        """
+        self.bad_epochs = 0 if val_loss < best_val_loss else self.bad_epochs + 1
+        return 0 < self.cfg.patience <= self.bad_epochs
+
+    def main_training_loop(self):
+        """
+        :return: Dict of results: epochs trained, best_val_loss, test_loss, stopped_early.
+        """
+        results = self.cfg.results
+        resume = self.cfg.resume
+        if resume == "auto":
+            resume = latest_checkpoint(os.path.join(results, "checkpoints"))
+
+        # Only rank 0 writes logs. They are continued when resuming.
+        os.makedirs(results, exist_ok=True)
+        topk = ",".join(f"top{k}" for k in TOPK)
+        headers = {
+            "logval.csv": "loss",
+            "train.csv": "epoch,step,loss,lr",
+            "logmetrics.csv": f"epoch,loss,{topk},silence,silence_pred",
+            "throughput.jsonl": None,
+        }
+        with ExitStack() as stack:
+            logs = []
+            for name, header in headers.items():
+                path = os.path.join(results, name) if self.rank == 0 else os.devnull
+                f = stack.enter_context(open(path, "a" if resume else "w"))
+                if header is not None and f.tell() == 0:
+                    f.write(header + "\n")
+                logs.append(f)
+            return self._main_training_loop(*logs, resume)
+
+    def _main_training_loop(self, logval, logtrain, logmetrics, logperf, resume: Optional[str] = None):
+        model = self.model
+        results = self.cfg.results
+        model_path = os.path.join(results, "model.pt")
+        best_model_path = os.path.join(results, "best_model.pt")
+        best_val_loss = float('inf')
+        start_epoch, start_batch = 1, 0
+
+        self.log("Training start.")
+        num_params = sum(p.numel() for p in model.parameters())
+        self.log(f"Number of learnable parameters: {num_params}")
+        if resume:
+            self.log("Resuming from", resume)
+            start_epoch, start_batch, best_val_loss = self.load_checkpoint(resume)
+        if self.cfg.profile > 0 and self.rank == 0:
+            self.profiler = make_profiler(device, self.cfg.profile, self.cfg.profile_wait,
+                                          os.path.join(results, "profile_trace.json"))
+            self.profiler.start()
+
+        epoch, stop = start_epoch - 1, False
+        for epoch in range(start_epoch, self.cfg.epochs + 1):
             epoch_start_time = time.time()
-            train(model, epoch)
-            val_loss = evaluate(model, val_data)
+            self.train(epoch, logtrain, logperf, start_batch if epoch == start_epoch else 0, best_val_loss)
+            metrics = self.evaluate(self.val_data)
+            summary = metrics.summary()
+            val_loss = summary["loss"]
             val_ppl = math.exp(val_loss)
             elapsed = time.time() - epoch_start_time
-            print('-' * 89)
-            print(f'| end of epoch {epoch:3d} | time: {elapsed:5.2f}s | '
-                f'valid loss {val_loss:5.2f} | valid ppl {val_ppl:8.2f}')
-            print('-' * 89)
+            self.log('-' * 89)
+            self.log(f'| end of epoch {epoch:3d} | time: {elapsed:5.2f}s | '
+                f'valid loss {val_loss:5.2f} | valid ppl {val_ppl:8.2f} | '
+                f'top1 {summary["top1"]:5.3f} | silence {summary["silence"]:5.3f} '
+                f'(predicted {summary["silence_pred"]:5.3f})')
+            self.log('-' * 89)
 
             logval.write(f"{val_loss}\n")
-            #logfile.flush()
-
-            """
-            plt.clf()
-            plt.imshow(confusion_matrix)
-            plt.savefig("results/confusion_matrix.jpg")
-            """
-
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                torch.save(model.state_dict(), best_model_params_path)
-
-            scheduler.step()
-            print("Saving to results/model.pt")
-            torch.save(model.state_dict(), "results/model.pt")
-
-        model.load_state_dict(torch.load(best_model_params_path)) # load best model states
-
-
-    test_loss = evaluate(model, test_data)
-    test_ppl = math.exp(test_loss)
-    print('=' * 89)
-    print(f'| End of training | test loss {test_loss:5.2f} | '
-          f'test ppl {test_ppl:8.2f}')
-    print('=' * 89)
+            logmetrics.write(f"{epoch}," + ",".join(str(v) for v in summary.values()) + "\n")
+            for f in (logval, logtrain, logmetrics, logperf):
+                f.flush()
+            if self.rank == 0:
+                metrics.save(results)
+
+            self.scheduler.step()
+            if self.rank == 0:
+                if val_loss < best_val_loss:
+                    atomic_save(model.state_dict(), best_model_path)
+                # Autocast never touches the parameters, so this is fp32 and loads
+                # for inference as usual.
+                print("Saving to", model_path)
+                atomic_save(model.state_dict(), model_path)
+            stop = self.should_stop(epoch, val_loss, best_val_loss)
+            best_val_loss = min(best_val_loss, val_loss)
+            self.save_checkpoint(epoch + 1, 0, best_val_loss)
+            if stop:
+                self.log(f"Stopping early after epoch {epoch}")
+                break
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.distributed:
+            dist.barrier()  # best model written by rank 0
+        if os.path.isfile(best_model_path):
+            model.load_state_dict(torch.load(best_model_path, map_location=device)) # load best model states
+
+        test_loss = self.evaluate(self.test_data).loss
+        test_ppl = math.exp(test_loss)
+        self.log('=' * 89)
+        self.log(f'| End of training | test loss {test_loss:5.2f} | '
+              f'test ppl {test_ppl:8.2f}')
+        self.log('=' * 89)
+        return {"epochs": epoch, "best_val_loss": best_val_loss, "test_loss": test_loss,
+                "stopped_early": stop}
+
+
+def run_worker(rank: int, cfg: Config):
+    """
+    Entry point of one data parallel process, started by run.
+    """
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    dist.init_process_group(cfg.backend, rank=rank, world_size=cfg.world_size)
+    try:
+        Trainer(cfg, rank, cfg.world_size).main_training_loop()
+    finally:
+        dist.destroy_process_group()
+
+def run(cfg: Config):
+    """
+    Train in this process, or start cfg.world_size data parallel processes.
+    Under torchrun (RANK set in the environment), join its process group instead.
+    """
+    if "RANK" in os.environ:
+        dist.init_process_group(cfg.backend)
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        # Rank 0 builds the dataset, the others wait for its config.
+        shared = [prepare_data(cfg) if rank == 0 else None]
+        dist.broadcast_object_list(shared, src=0)
+        cfg = shared[0]
+        try:
+            Trainer(cfg, rank, world_size).main_training_loop()
+        finally:
+            dist.destroy_process_group()
+    elif cfg.world_size > 1:
+        # Build the dataset once, before the workers open it.
+        mp.spawn(run_worker, args=(prepare_data(cfg),), nprocs=cfg.world_size)
+    else:
+        Trainer(prepare_data(cfg)).main_training_loop()
 
 
 if __name__ == "__main__":
-    with open("results/logval.csv", "w") as logval, open("results/logtrain.csv", "w") as logtrain:
-        logval.write("loss\n")
-        logtrain.write("loss,lr\n")
-        main_training_loop()
+    run(Config.from_args())
@@ -1,13 +1,127 @@
-import time
+"""
+Framing of the server protocol: each message is a 4 byte little endian length,
+then that many bytes of JSON. Blocking socket and asyncio stream versions.
 
+Connections that negotiated the binary format (see server.py) may also send messages
+carrying notes as one kind byte followed by packed NOTE records:
+AUTOCOMPLETE / AUTOCOMPLETE_STREAM: a request, as {"type": "autocomplete", "data": notes}
+DATA: {"data": notes}, NOTE_EVENT: {"note": note} (one record), DONE: {"done": true}
+Other messages (e.g. errors) are always JSON. JSON messages start with a printable
+character, so the kinds are told apart by the first byte.
+"""
 
-def recv(conn, length: int):
-    data = b""
-    tries = 0
+import json
+import struct
+
+import numpy as np
+
+HEADER = struct.Struct("<I")
+# Larger frames are refused, so a bad length can't make the reader allocate gigabytes.
+MAX_FRAME = 1 << 26
+
+# Binary note record (9 bytes, packed)
+NOTE = np.dtype([("note", "u1"), ("start", "<f4"), ("end", "<f4")])
+AUTOCOMPLETE, AUTOCOMPLETE_STREAM, DATA, NOTE_EVENT, DONE = b"\x01", b"\x02", b"\x03", b"\x04", b"\x05"
+BINARY_KINDS = (AUTOCOMPLETE, AUTOCOMPLETE_STREAM, DATA, NOTE_EVENT, DONE)
+
+
+def recv(conn, length: int) -> bytes:
+    """
+    Read exactly length bytes from a blocking socket.
+    Timeouts are those of the socket (conn.settimeout).
+    """
+    data = bytearray()
     while len(data) < length:
-        time.sleep(0.005)
-        data += conn.recv(length - len(data))
-        tries += 1
-        if tries > 1000:
-            raise Exception("recv timeout")
-    return data
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+def pack_notes(notes) -> bytes:
+    """
+    :param notes: List of (note, start, end), or a NOTE array.
+    """
+    if isinstance(notes, np.ndarray) and notes.dtype == NOTE:
+        return notes.tobytes()
+    values = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+    packed = np.empty(len(values), dtype=NOTE)
+    packed["note"], packed["start"], packed["end"] = values.T
+    return packed.tobytes()
+
+def to_binary(obj):
+    """
+    :return: Binary payload of a message, or None if it is sent as JSON.
+    """
+    if not isinstance(obj, dict):
+        return None
+    if obj.get("type") == "autocomplete" and "data" in obj:
+        return (AUTOCOMPLETE_STREAM if obj.get("stream") else AUTOCOMPLETE) + pack_notes(obj["data"])
+    if obj.keys() == {"data"}:
+        return DATA + pack_notes(obj["data"])
+    if obj.keys() == {"note"}:
+        return NOTE_EVENT + pack_notes([obj["note"]])
+    if obj == {"done": True}:
+        return DONE
+    return None
+
+def decode(payload: bytes):
+    """
+    Message of a frame's payload. Notes of binary messages are NOTE arrays viewing
+    the payload, not copies.
+    """
+    kind = payload[:1]
+    if kind not in BINARY_KINDS:
+        return json.loads(payload)
+    # Raises ValueError if the size isn't a whole number of records.
+    notes = np.frombuffer(payload, dtype=NOTE, offset=1)
+    if kind in (AUTOCOMPLETE, AUTOCOMPLETE_STREAM):
+        msg = {"type": "autocomplete", "data": notes}
+        if kind == AUTOCOMPLETE_STREAM:
+            msg["stream"] = True
+        return msg
+    if kind == DATA:
+        return {"data": notes}
+    if kind == NOTE_EVENT:
+        if len(notes) != 1:
+            raise ValueError("Note event without exactly one note")
+        return {"note": notes[0]}
+    return {"done": True}
+
+def encode(obj, binary: bool = False) -> bytes:
+    """
+    :param binary: Send obj in binary if it has a binary form.
+    """
+    data = to_binary(obj) if binary else None
+    if data is None:
+        data = json.dumps(obj).encode()
+    return HEADER.pack(len(data)) + data
+
+def frame_length(header: bytes) -> int:
+    length = HEADER.unpack(header)[0]
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes is too large")
+    return length
+
+
+def send_msg(conn, obj, binary: bool = False):
+    conn.sendall(encode(obj, binary))
+
+def recv_msg(conn):
+    length = frame_length(recv(conn, HEADER.size))
+    return decode(recv(conn, length))
+
+
+async def read_msg(reader):
+    """
+    Raises asyncio.IncompleteReadError if the connection closes, even between messages.
+    """
+    length = frame_length(await reader.readexactly(HEADER.size))
+    return decode(await reader.readexactly(length))
+
+async def write_msg(writer, obj, binary: bool = False):
+    """
+    Waits while the transport's write buffer is full (backpressure from slow readers).
+    """
+    writer.write(encode(obj, binary))
+    await writer.drain()
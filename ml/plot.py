@@ -1,3 +1,5 @@
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -9,7 +11,7 @@ plt.title("Validation loss")
 plt.plot(np.arange(len(data)), data["loss"], label="Validation loss")
 
 # Training data
-data = pd.read_csv("results/logtrain.csv")
+data = pd.read_csv("results/train.csv")
 
 f = plt.figure(2)
 plt.title("Training loss")
@@ -21,4 +23,13 @@ plt.title("Learning rate")
 plt.plot(x, data["lr"], label="lr")
 
 plt.legend()
+
+# Last validation confusion matrix (see metrics.py)
+if os.path.isfile("results/confusion_matrix.npy"):
+    f = plt.figure(4)
+    plt.title("Confusion matrix (log)")
+    plt.imshow(np.log1p(np.load("results/confusion_matrix.npy")))
+    plt.xlabel("Predicted")
+    plt.ylabel("Actual")
+
 plt.show()
@@ -0,0 +1,126 @@
+"""
+Training throughput instrumentation: phase timings, tokens/sec and peak memory.
+
+Nothing here synchronizes with the device while training runs. Losses are kept as
+tensors and GPU phases are timed with CUDA events; all of it is read back at once
+by StepStats.summary, every log interval.
+"""
+
+import resource
+import time
+from contextlib import contextmanager
+
+import torch
+from torch import Tensor
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+PHASES = ("data", "forward", "backward", "optimizer")
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    """
+    Peak allocated memory on the GPU since the last reset, or peak resident set size
+    of the process on CPU (never reset).
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class StepStats:
+    """
+    Collects training steps between two summaries.
+    """
+
+    def __init__(self, device: torch.device, tokens_per_step: int):
+        """
+        :param tokens_per_step: Tokens trained on per optimizer step (on this rank).
+        """
+        self.device = device
+        self.cuda = device.type == "cuda"
+        self.tokens_per_step = tokens_per_step
+        self.reset()
+
+    def reset(self):
+        self.timings = []  # (phase, start, end)
+        self.losses = []
+        self.lrs = []
+        self.start = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time a phase of the current step. Also labels it in profiler traces.
+        """
+        with record_function(name):
+            if self.cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+            else:
+                start = time.perf_counter()
+                yield
+                end = time.perf_counter()
+        self.timings.append((name, start, end))
+
+    def step(self, loss: Tensor, lr: float):
+        """
+        End of an optimizer step.
+        :param loss: Mean loss of the step; not read until summary.
+        """
+        self.losses.append(loss.detach())
+        self.lrs.append(lr)
+
+    def summary(self):
+        """
+        Read back everything since the last reset (one device sync), and reset.
+
+        :return: (losses, lrs, record). Loss and learning rate of each step, and a dict of
+            averages: loss, ms_per_step, tokens_per_sec, <phase>_ms per step, peak_mem_mb.
+        """
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - self.start
+        steps = max(len(self.losses), 1)
+
+        ms = dict.fromkeys(PHASES, 0.)
+        for name, start, end in self.timings:
+            ms[name] += start.elapsed_time(end) if self.cuda else (end - start) * 1000
+        losses = torch.stack(self.losses).float().tolist() if self.losses else []
+        lrs = self.lrs
+        record = {
+            "steps": len(losses),
+            "loss": sum(losses) / steps,
+            "ms_per_step": elapsed * 1000 / steps,
+            "tokens_per_sec": self.tokens_per_step * len(losses) / elapsed,
+            **{f"{name}_ms": total / steps for name, total in ms.items()},
+            "peak_mem_mb": peak_memory_mb(self.device),
+        }
+        self.reset()
+        return losses, lrs, record
+
+
+def make_profiler(device: torch.device, steps: int, wait: int, path: str):
+    """
+    torch.profiler over one window of steps (call .step() after each step), written to
+    path as a Chrome trace (open in chrome://tracing or Perfetto).
+
+    :param steps: Number of steps traced.
+    :param wait: Steps skipped before, so that startup isn't traced.
+    """
+    activities = [ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(ProfilerActivity.CUDA)
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(path)
+        print(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+        print("Profiler trace saved to", path)
+
+    return profile(activities=activities, schedule=schedule(wait=wait, warmup=1, active=steps, repeat=1),
+                   on_trace_ready=on_trace_ready, profile_memory=True)
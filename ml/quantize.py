@@ -0,0 +1,77 @@
+"""
+Export a dynamically quantized int8 model for CPU inference, and compare it to fp32.
+
+python quantize.py --model results/model.pt --out results/model_int8.pt --compare --dt 0.12
+
+The int8 model loads with transformer.load_model, e.g. server.py --model results/model_int8.pt
+With --compare, both models are evaluated on the test split (other arguments are
+passed to model.py's Config, for the dataset and eval batch size), and generation
+latency is measured.
+"""
+
+import argparse
+import os
+
+import torch
+
+from metrics import Metrics
+from model import Batchified, Config, batchify, get_batch, load_data, split_data
+from run import MODEL_PATH, time_generation
+from transformer import TransformerModel, load_model, model_sizes, quantize_dynamic, save_quantized
+
+cpu = torch.device("cpu")
+
+
+def evaluate(model: TransformerModel, test_data: Batchified, cfg: Config, max_batches: int = 0) -> Metrics:
+    """
+    Metrics of model on test_data, decoding with forward_cached as served.
+    :param max_batches: Stop after this many eval batches; 0 for all of it.
+    """
+    metrics = Metrics(cfg.ntokens)
+    with torch.no_grad():
+        for n, i in enumerate(range(0, test_data.size(0) - 1, cfg.bptt)):
+            if 0 < max_batches <= n:
+                break
+            data, targets = get_batch(test_data, i, cfg.bptt)
+            output, _ = model.forward_cached(data.to(cpu))
+            metrics.update(output.view(-1, cfg.ntokens), targets.to(cpu))
+    return metrics
+
+
+def compare(fp32: TransformerModel, int8: TransformerModel, cfg: Config, max_batches: int = 0):
+    print("Evaluating on the test split...")
+    test_data = batchify(split_data(load_data(cfg))[2], cfg.eval_batch_size)
+    results = {name: evaluate(model, test_data, cfg, max_batches).summary()
+               for name, model in (("fp32", fp32), ("int8", int8))}
+    for key in results["fp32"]:
+        a, b = results["fp32"][key], results["int8"][key]
+        print(f"{key:>14}: fp32 {a:.4f}  int8 {b:.4f}  diff {b - a:+.4f}")
+
+    print("Generation latency (ms/token):")
+    for batch_size in (1, 8):
+        a, b = time_generation(fp32, batch_size), time_generation(int8, batch_size)
+        print(f"{'batch ' + str(batch_size):>14}: fp32 {a:.2f}  int8 {b:.2f}  speedup {a / b:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a model to int8. "
+                                     "Other arguments are passed to model.py's Config.")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--out", default="results/model_int8.pt")
+    parser.add_argument("--nhead", type=int, default=4, help="Must match training")
+    parser.add_argument("--compare", action="store_true", help="Report accuracy and latency against fp32")
+    parser.add_argument("--max-batches", type=int, default=0, help="Limit the test split (0 for all)")
+    args, rest = parser.parse_known_args()
+
+    fp32 = load_model(args.model, cpu, args.nhead)
+    int8 = quantize_dynamic(fp32)
+    save_quantized(int8, model_sizes(fp32), args.out)
+    size = lambda path: os.path.getsize(path) / 2**20
+    print(f"Saved {args.out} ({size(args.out):.1f} MB, fp32 {size(args.model):.1f} MB)")
+
+    if args.compare:
+        compare(fp32, int8, Config.from_args(rest), args.max_batches)
+
+
+if __name__ == "__main__":
+    main()
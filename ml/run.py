@@ -4,15 +4,21 @@ i.e. utilities for running the model on an existing midi file.
 """
 
 import argparse
+import time
 
 import matplotlib.pyplot as plt
 import mido
 import numpy as np
 import torch
+import torch.nn.functional as F
 from tqdm import trange
 
 from midi import tokenize_interval, events_to_midi, DT
-from model import *
+from transformer import TransformerModel, generate_square_subsequent_mask, load_model
+
+MODEL_PATH = "results/model.pt"
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class TemperedSoftmax(torch.nn.Module):
@@ -24,35 +30,125 @@ class TemperedSoftmax(torch.nn.Module):
         return F.softmax(x * self.temp, dim=-1)
 
 
-def main(input_path, output_path, length):
-    midi = mido.MidiFile(input_path)
-    src = tokenize_interval(midi, (0, 127))
-    src = torch.tensor(src, device=device).unsqueeze(1)
-    model.load_state_dict(torch.load("results/model.pt"))
-    print(src.shape)
+def generate(model: TransformerModel, src, length, temp: float = 1, use_cache: bool = True):
+    """
+    Sample length tokens following src.
+
+    :param src: Tensor, shape [seq_len, 1]
+    :param use_cache: Decode incrementally with model.forward_cached. Otherwise the whole
+        sequence is run through the model at every step.
+    :return: List of generated tokens.
+    """
+    preds = []
+    softmax = TemperedSoftmax(temp=temp)
+    cache = None
+    inputs = src
+    with torch.no_grad():
+        for _ in trange(length):
+            if use_cache:
+                output, cache = model.forward_cached(inputs, cache)
+            else:
+                src_mask = generate_square_subsequent_mask(src.size(0)).to(device)
+                output = model(src, src_mask)
+            pred = output[-1].squeeze().cpu()
+            pred = softmax(pred).numpy()
+
+            """
+            plt.clf()
+            plt.plot(pred)
+            plt.pause(.01)
+            """
+
+            pred = np.random.choice(128, p=pred)
+            #pred[0] *= 0.5
+            #pred = np.argmax(pred)
+            preds.append(pred)
+
+            inputs = pred * torch.ones(1, 1, dtype=torch.long, device=device)
+            if not use_cache:
+                src = torch.cat([src, inputs], dim=0)
+
+    return preds
+
+
+def load_inference_model(path: str, device=device):
+    """
+    A graph exported by export.py (.ts), or any model load_model reads.
+    """
+    if path.endswith(".ts"):
+        return torch.jit.load(path, map_location=device)
+    return load_model(path, device)
+
+
+def warmup(model: TransformerModel):
+    """
+    Run a short generation so that the first real request doesn't pay for
+    lazy initialization (allocator, kernel selection).
+    """
+    src = torch.zeros(8, 1, dtype=torch.long, device=device)
+    generate(model, src, 2)
+
+
+def generate_batch(model: TransformerModel, prompts, length, temp: float = 1, on_step=None):
+    """
+    Sample length tokens following each prompt, decoding all of them in one batch.
+    Prompts are left padded to the same length.
+
+    :param prompts: List of 1D token tensors.
+    :param on_step: Called as on_step(step, tokens) as soon as each step is sampled,
+        tokens being the list of new tokens, one per prompt.
+    :return: List of generated token lists, one per prompt.
+    """
+    lens = [len(p) for p in prompts]
+    src = torch.zeros(max(lens), len(prompts), dtype=torch.long, device=prompts[0].device)
+    for i, prompt in enumerate(prompts):
+        src[src.size(0) - lens[i]:, i] = prompt
+    pad = torch.tensor([src.size(0) - n for n in lens], device=src.device)
 
     preds = []
-    src_mask = generate_square_subsequent_mask(src.size(0)).to(device)
-    sigmoid = TemperedSoftmax(temp=1)
-    for _ in trange(length):
-        output = model(src, src_mask)
-        pred = output[-1].squeeze().cpu().detach()
-        pred = sigmoid(pred).numpy()
-
-        """
-        plt.clf()
-        plt.plot(pred)
-        plt.pause(.01)
-        """
-
-        pred = np.random.choice(128, p=pred)
-        #pred[0] *= 0.5
-        #pred = np.argmax(pred)
-        preds.append(pred)
-
-        src = torch.cat([src, pred * torch.ones(1, 1, dtype=torch.long, device=device)], dim=0)
-        src_mask = generate_square_subsequent_mask(src.size(0)).to(device)
+    softmax = TemperedSoftmax(temp=temp)
+    with torch.no_grad():
+        output, cache = model.forward_cached(src, None, pad)
+        for step in range(length):
+            pred = torch.multinomial(softmax(output[-1]), 1)  # [batch_size, 1]
+            preds.append(pred)
+            if on_step is not None:
+                on_step(step, pred[:, 0].tolist())
+            if step < length - 1:
+                output, cache = model.forward_cached(pred.t(), cache, pad)
+
+    if not preds:
+        return [[] for _ in prompts]
+    return torch.cat(preds, dim=1).tolist()
+
+
+def time_generation(model, batch_size: int, prompt_len: int = 64, length: int = 32,
+                    repeats: int = 3) -> float:
+    """
+    Benchmark generate_batch on random prompts.
+    :return: Milliseconds per generated token (best of repeats).
+    """
+    prompts = [torch.randint(1, 128, (prompt_len,), device=device) for _ in range(batch_size)]
+    generate_batch(model, prompts, 2)  # warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        generate_batch(model, prompts, length)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000 / length
+
+
+def load_prompt(path):
+    """
+    Tokenize a MIDI file for generation.
+    :return: Tensor, shape [seq_len]
+    """
+    midi = mido.MidiFile(path)
+    src = tokenize_interval(midi, (0, 127))
+    return torch.tensor(src, dtype=torch.long, device=device)
+
 
+def save_preds(preds, path):
     messages = []
     num_zeros = 0
     for pred in preds:
@@ -74,7 +170,15 @@ def main(input_path, output_path, length):
         events.append((DT*count, msg[0], False))
 
     midi = events_to_midi(events)
-    midi.save(output_path)
+    midi.save(path)
+
+
+def main(model: TransformerModel, input_path, output_path, length, use_cache: bool = True):
+    src = load_prompt(input_path).unsqueeze(1)
+    print(src.shape)
+
+    preds = generate(model, src, length, use_cache=use_cache)
+    save_preds(preds, output_path)
 
 
 if __name__ == "__main__":
@@ -82,5 +186,9 @@ if __name__ == "__main__":
     parser.add_argument("input", help="Input MIDI file")
     parser.add_argument("output", help="Output MIDI file")
     parser.add_argument("--length", default=16, type=int)
+    parser.add_argument("--no-cache", action="store_true", help="Recompute the full sequence every step")
+    parser.add_argument("--model", default=MODEL_PATH,
+                        help="Weights, an int8 model from quantize.py or a graph from export.py")
     args = parser.parse_args()
-    main(args.input, args.output, args.length)
+    model = load_inference_model(args.model)
+    main(model, args.input, args.output, args.length, use_cache=not args.no_cache)
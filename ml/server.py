@@ -21,65 +21,205 @@ Response is:
         ...
     ]
 }
+or {"error": "..."} if the request is invalid.
+
+With "stream": true in the request, notes are sent as soon as they are generated,
+one message each:
+{"note": [note, start, end]}
+and the response ends with {"done": true} (or an error message).
+
+Notes can also be sent in a compact binary form (see net.py), after negotiating it:
+the client sends {"type": "hello", "formats": ["binary", "json"]} (by preference), and
+the server answers {"format": "binary"} with the first one it supports. Responses on
+the connection are then binary; requests may be either. Servers without binary
+support answer {"error": ...}, so clients fall back to JSON.
+
+Connections are kept open: a client can send any number of requests on one, and
+responses come back in order.
 """
 
-import json
-import struct
-import time
-from threading import Thread
-from socket import socket, AF_INET, SOCK_STREAM
+import argparse
+import asyncio
+import signal
 
-import mido
+import torch
 
-from midi import events_to_midi
-from net import recv
-from run import main as run_main
+from batching import Batcher
+from midi import notes_to_tokens, token_to_note, tokens_to_notes
+from net import read_msg, write_msg
+from run import MODEL_PATH, device, load_inference_model, warmup
 
 PORT = 7610
+# Note encodings the server can respond in (see net.py)
+FORMATS = ("binary", "json")
+# Prompts are cut to their last MAX_PROMPT tokens. The model is trained on much shorter
+# windows anyway, and exported graphs (export.py) have a fixed max length.
+MAX_PROMPT = 256
 
 
-def handle_client(conn):
-    length = struct.unpack("<I", conn.recv(4))[0]
-    data = json.loads(conn.recv(length).decode())
-    if data["type"] == "autocomplete":
-        events = []
-        for note in data["data"]:
-            events.append((note[1], int(note[0]), 1))
-            events.append((note[2], int(note[0]), 0))
-        events.sort(key=lambda x: x[0])
-        print(events)
-        midi = events_to_midi(events)
-        midi.save("server.mid")
-        run_main("server.mid", "pred.mid", 16)
-
-        midi = mido.MidiFile("pred.mid")
-        messages = []
-        starts = {}
-        time = 0
-        for msg in midi:
-            time += msg.time
-            if msg.type == "note_on":
-                starts[msg.note] = time
-            elif msg.type == "note_off":
-                if msg.note in starts:
-                    messages.append((msg.note, starts[msg.note], time))
-                    del starts[msg.note]
-
-        data = json.dumps({"data": messages})
-        conn.send(struct.pack("<I", len(data)))
-        conn.send(data.encode())
+def prompt_tensor(notes):
+    return torch.tensor(notes_to_tokens(notes)[-MAX_PROMPT:], dtype=torch.long, device=device)
 
+async def autocomplete(batcher: Batcher, notes, length: int = 16):
+    """
+    Generate a continuation of notes, entirely in memory. Tokenizing runs in the
+    default executor and decoding in the batcher's thread; the event loop only waits.
 
-def main():
-    sock = socket(AF_INET, SOCK_STREAM)
-    sock.bind(("", PORT))
-    sock.listen()
-    print("Listening on port", PORT)
-    while True:
-        conn, addr = sock.accept()
+    :param notes: List of (note, start, end)
+    :return: List of (note, start, end), with times relative to the end of the prompt.
+    """
+    loop = asyncio.get_running_loop()
+    src = await loop.run_in_executor(None, prompt_tensor, notes)
+    preds = await asyncio.wrap_future(batcher.submit(src, length))
+    return tokens_to_notes(preds)
+
+async def autocomplete_stream(batcher: Batcher, notes, length: int = 16):
+    """
+    Like autocomplete, but yields each note as soon as its token is generated.
+    """
+    loop = asyncio.get_running_loop()
+    src = await loop.run_in_executor(None, prompt_tensor, notes)
+    # Tokens are handed over from the batcher's thread, followed by None when done.
+    tokens = asyncio.Queue()
+    future = batcher.submit(src, length,
+                            lambda i, token: loop.call_soon_threadsafe(tokens.put_nowait, (i, token)))
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(tokens.put_nowait, None))
+    while (item := await tokens.get()) is not None:
+        if (note := token_to_note(item[1], item[0])) is not None:
+            yield note
+    # Raises if generation failed.
+    await asyncio.wrap_future(future)
+
+
+def negotiate(formats) -> str:
+    """
+    :param formats: Formats supported by the client, by preference.
+    """
+    if isinstance(formats, list):
+        for format in formats:
+            if format in FORMATS:
+                return format
+    return "json"
+
+
+class Server:
+    """
+    asyncio server. Each connection is served by a task, one request at a time.
+    """
+
+    def __init__(self, batcher: Batcher, max_pending: int = 64, shutdown_timeout: float = 10):
+        """
+        :param max_pending: Max requests being processed, over all connections. Past that,
+            connections are not read from, so clients are slowed down by TCP flow control.
+        :param shutdown_timeout: Seconds to let requests in progress finish when stopping.
+        """
+        self.batcher = batcher
+        self.pending = asyncio.Semaphore(max_pending)
+        self.shutdown_timeout = shutdown_timeout
+        self.stopping = asyncio.Event()
+        # Connection task -> (its StreamWriter, whether it is processing a request)
+        self.clients = {}
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        addr = writer.get_extra_info("peername")
         print("Connection from", addr)
-        Thread(target=handle_client, args=(conn,)).start()
-        
+        self.clients[task] = (writer, False)
+        binary = False
+        try:
+            while not self.stopping.is_set():
+                try:
+                    data = await read_msg(reader)
+                except asyncio.IncompleteReadError:
+                    break  # closed by the client, or by shutdown if idle
+                self.clients[task] = (writer, True)
+                if isinstance(data, dict) and data.get("type") == "hello":
+                    format = negotiate(data.get("formats"))
+                    binary = format == "binary"
+                    await write_msg(writer, {"format": format})
+                else:
+                    async with self.pending:
+                        async for response in self.respond(data):
+                            await write_msg(writer, response, binary)
+                self.clients[task] = (writer, False)
+        except (ConnectionError, ValueError) as e:
+            print(f"Closing {addr}: {type(e).__name__}: {e}")
+        except asyncio.CancelledError:
+            print(f"Closing {addr}: request not finished before shutdown")
+        finally:
+            del self.clients[task]
+            writer.close()
+
+    async def respond(self, data):
+        """
+        Yields the response messages to a request.
+        """
+        if not isinstance(data, dict) or data.get("type") != "autocomplete":
+            yield {"error": "Unknown request"}
+            return
+        try:
+            if data.get("stream"):
+                async for note in autocomplete_stream(self.batcher, data["data"]):
+                    yield {"note": note}
+                yield {"done": True}
+            else:
+                yield {"data": await autocomplete(self.batcher, data["data"])}
+        except (KeyError, TypeError, ValueError) as e:
+            yield {"error": f"Invalid request: {e}"}
+        except Exception as e:
+            # Generation failed (e.g. in the model); the connection stays usable.
+            print(f"Request failed: {type(e).__name__}: {e}")
+            # Errors of exported graphs carry the TorchScript traceback; keep its last line.
+            message = str(e).strip().splitlines()[-1] if str(e).strip() else type(e).__name__
+            yield {"error": f"Generation failed: {message}"}
+
+    async def serve(self, host: str = "", port: int = PORT):
+        """
+        Run until SIGINT or SIGTERM, then shut down gracefully: stop accepting, close idle
+        connections and give requests in progress shutdown_timeout seconds to finish.
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print("Listening on port", port)
+        await self.stopping.wait()
+
+        print("Shutting down...")
+        server.close()
+        for writer, busy in list(self.clients.values()):
+            if not busy:
+                writer.close()
+        if self.clients:
+            done, late = await asyncio.wait(list(self.clients), timeout=self.shutdown_timeout)
+            for task in late:
+                task.cancel()
+            await asyncio.gather(*late, return_exceptions=True)
+        await server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-batch", type=int, default=8, help="Max requests decoded together")
+    parser.add_argument("--max-wait", type=float, default=10, help="Max ms to wait for a batch to fill")
+    parser.add_argument("--max-pending", type=int, default=64, help="Max requests in progress")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--model", default=MODEL_PATH,
+                        help="Weights, an int8 model from quantize.py or a graph from export.py (.ts)")
+    args = parser.parse_args()
+
+    # Loaded once and kept resident; requests share it.
+    print("Loading model from", args.model)
+    model = load_inference_model(args.model)
+    warmup(model)
+    batcher = Batcher(model, args.max_batch, args.max_wait / 1000)
+    batcher.start()
+    try:
+        asyncio.run(Server(batcher, args.max_pending).serve(port=args.port))
+    finally:
+        batcher.stop()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,243 @@
+"""
+Transformer architecture, shared by training (model.py) and inference (run.py, server.py).
+"""
+
+import copy
+import math
+from typing import List, Optional, Tuple, Union
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+from torch.nn import TransformerEncoder, TransformerEncoderLayer
+from torch.utils.checkpoint import checkpoint
+
+
+class TransformerModel(nn.Module):
+
+    def __init__(self, ntoken: int, d_model: int, nhead: int, d_hid: int,
+                 nlayers: int, dropout: float = 0.5):
+        super().__init__()
+        self.model_type = 'Transformer'
+        self.pos_encoder = PositionalEncoding(d_model, dropout)
+        encoder_layers = TransformerEncoderLayer(d_model, nhead, d_hid, dropout)
+        self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
+        self.encoder = nn.Embedding(ntoken, d_model)
+        self.d_model = d_model
+        self.decoder = nn.Linear(d_model, ntoken)
+        # Activation checkpointing: in training, keep only the input of each encoder layer
+        # and recompute the rest during backward. Trades compute for memory.
+        self.checkpoint_layers = False
+
+        self.init_weights()
+
+    def init_weights(self) -> None:
+        initrange = 0.1
+        self.encoder.weight.data.uniform_(-initrange, initrange)
+        self.decoder.bias.data.zero_()
+        self.decoder.weight.data.uniform_(-initrange, initrange)
+
+    def forward(self, src: Tensor, src_mask: Tensor) -> Tensor:
+        """
+        Args:
+            src: Tensor, shape [seq_len, batch_size]
+            src_mask: Tensor, shape [seq_len, seq_len]
+
+        Returns:
+            output Tensor of shape [seq_len, batch_size, ntoken]
+        """
+        src = self.encoder(src) * math.sqrt(self.d_model)
+        src = self.pos_encoder(src)
+        if self.checkpoint_layers and self.training and torch.is_grad_enabled():
+            output = src
+            for layer in self.transformer_encoder.layers:
+                output = checkpoint(layer, output, src_mask, use_reentrant=False)
+        else:
+            output = self.transformer_encoder(src, src_mask)
+        output = self.decoder(output)
+        return output
+
+    def forward_cached(self, src: Tensor, cache: Optional[List[Tuple[Tensor, Tensor]]] = None,
+                       pad: Optional[Tensor] = None) -> Tuple[Tensor, List[Tuple[Tensor, Tensor]]]:
+        """
+        Incremental (KV-cached) version of forward, for generation.
+        Only the new tokens are run through the stack; keys and values of earlier
+        positions are taken from the cache. Causal masking is implied.
+        Matches forward with a square subsequent mask (in eval mode).
+
+        Args:
+            src: Tensor, shape [new_len, batch_size]. Tokens following the cached ones.
+            cache: Per layer (key, value) returned by the previous call, or None
+                to start a new sequence.
+            pad: Tensor, shape [batch_size]. Number of padding tokens at the start of
+                each sequence (left padding), which are ignored. Must be the same
+                for every call on one sequence.
+
+        Returns:
+            tuple (output, cache), where output has shape [new_len, batch_size, ntoken]
+        """
+        seq_len = src.size(0)
+        past_len = 0 if cache is None else cache[0][0].size(2)
+        src = self.encoder(src) * math.sqrt(self.d_model)
+        src = self.pos_encoder(src, offset=past_len if pad is None else past_len - pad)
+
+        # New position i may see all cached positions, and new positions up to i.
+        # Padding is hidden from every position but itself.
+        mask = None
+        if seq_len > 1 or pad is not None:
+            keys = torch.arange(past_len + seq_len, device=src.device)
+            queries = torch.arange(past_len, past_len + seq_len, device=src.device).unsqueeze(1)
+            mask = keys <= queries
+            if pad is not None:
+                mask = mask & ((keys >= pad.view(-1, 1, 1)) | (keys == queries))
+                mask = mask.unsqueeze(1)  # [batch_size, 1, new_len, total_len]
+
+        new_cache = []
+        for i, layer in enumerate(self.transformer_encoder.layers):
+            src, kv = cached_layer_forward(layer, src, None if cache is None else cache[i], mask)
+            new_cache.append(kv)
+        output = self.decoder(src)
+        return output, new_cache
+
+
+def cached_layer_forward(layer: TransformerEncoderLayer, x: Tensor, kv: Optional[Tuple[Tensor, Tensor]],
+                         mask: Optional[Tensor] = None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+    """
+    Same computation as TransformerEncoderLayer.forward (post-norm), but attention
+    keys and values of previous positions are read from kv.
+
+    Args:
+        x: Tensor, shape [new_len, batch_size, d_model]
+        kv: tuple (key, value), each of shape [batch_size, nhead, past_len, head_dim]
+        mask: Boolean attention mask (True = attend), broadcastable to
+            [batch_size, nhead, new_len, past_len + new_len]
+
+    Returns:
+        tuple (output, kv), with kv extended by the new positions.
+    """
+    attn = layer.self_attn
+    seq_len, bsz, d_model = x.shape
+    nhead = attn.num_heads
+    head_dim = d_model // nhead
+
+    in_proj = getattr(attn, "in_proj", None)  # set by quantize_dynamic
+    if in_proj is not None:
+        qkv = in_proj(x)
+    else:
+        qkv = F.linear(x, attn.in_proj_weight, attn.in_proj_bias)
+    q, k, v = qkv.chunk(3, dim=-1)
+    # [seq_len, batch_size, d_model] -> [batch_size, nhead, seq_len, head_dim]
+    q, k, v = (t.reshape(seq_len, bsz, nhead, head_dim).permute(1, 2, 0, 3) for t in (q, k, v))
+    if kv is not None:
+        k = torch.cat([kv[0], k], dim=2)
+        v = torch.cat([kv[1], v], dim=2)
+
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    out = out.permute(2, 0, 1, 3).reshape(seq_len, bsz, d_model)
+    out = attn.out_proj(out)
+
+    x = layer.norm1(x + layer.dropout1(out))
+    ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+    x = layer.norm2(x + layer.dropout2(ff))
+    return x, (k, v)
+
+
+def generate_square_subsequent_mask(sz: int) -> Tensor:
+    """Generates an upper-triangular matrix of -inf, with zeros on diag."""
+    return torch.triu(torch.ones(sz, sz) * float('-inf'), diagonal=1)
+
+
+class PositionalEncoding(nn.Module):
+
+    def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
+        super().__init__()
+        self.dropout = nn.Dropout(p=dropout)
+
+        position = torch.arange(max_len).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
+        pe = torch.zeros(max_len, 1, d_model)
+        pe[:, 0, 0::2] = torch.sin(position * div_term)
+        pe[:, 0, 1::2] = torch.cos(position * div_term)
+        self.register_buffer('pe', pe)
+
+    def forward(self, x: Tensor, offset: Union[int, Tensor] = 0) -> Tensor:
+        """
+        Args:
+            x: Tensor, shape [seq_len, batch_size, embedding_dim]
+            offset: int, position of the first element of x. Or Tensor of shape
+                [batch_size], one per sequence; negative positions are clamped to 0.
+        """
+        if isinstance(offset, Tensor):
+            positions = torch.arange(x.size(0), device=x.device).unsqueeze(1) + offset
+            x = x + self.pe[positions.clamp(min=0), 0]
+        else:
+            x = x + self.pe[offset:offset + x.size(0)]
+        return self.dropout(x)
+
+
+def model_sizes(model: TransformerModel):
+    """
+    Constructor arguments of model (except dropout).
+    """
+    layer = model.transformer_encoder.layers[0]
+    return {"ntoken": model.decoder.out_features, "d_model": model.d_model,
+            "nhead": layer.self_attn.num_heads, "d_hid": layer.linear1.out_features,
+            "nlayers": len(model.transformer_encoder.layers)}
+
+
+def quantize_dynamic(model: TransformerModel) -> TransformerModel:
+    """
+    Copy of model with int8 weights in every Linear: attention projections, feed forward
+    and decoder. Activations are quantized on the fly (dynamic quantization). CPU only.
+
+    Attention input projections are moved to Linear modules (attn.in_proj) so that they
+    can be quantized; only forward_cached uses them, so forward is not supported.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for layer in model.transformer_encoder.layers:
+        attn = layer.self_attn
+        d_model = attn.embed_dim
+        attn.in_proj = nn.Linear(d_model, 3 * d_model)
+        attn.in_proj.weight, attn.in_proj.bias = attn.in_proj_weight, attn.in_proj_bias
+        attn.in_proj_weight = attn.in_proj_bias = None
+        # MultiheadAttention's out_proj type is excluded from dynamic quantization, because
+        # its forward reads the weight directly. forward_cached calls it as a module.
+        out_proj = nn.Linear(d_model, d_model)
+        out_proj.weight, out_proj.bias = attn.out_proj.weight, attn.out_proj.bias
+        attn.out_proj = out_proj
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model: TransformerModel, sizes, path: str):
+    """
+    Save a model returned by quantize_dynamic, for load_model.
+    :param sizes: model_sizes of the original model.
+    """
+    torch.save({"format": "int8_dynamic", "sizes": sizes, "state_dict": model.state_dict()}, path)
+
+
+def load_model(path: str, device=None, nhead: int = 4) -> TransformerModel:
+    """
+    Build an inference-only model from a state dict saved by model.py, or an int8 model
+    saved by save_quantized (CPU only).
+    Sizes are inferred from the weights; nhead cannot be, so it must match training.
+    """
+    state = torch.load(path, map_location=device, weights_only=False)
+    if state.get("format") == "int8_dynamic":
+        if device is not None and torch.device(device).type != "cpu":
+            raise ValueError("int8 models run on CPU only")
+        model = quantize_dynamic(TransformerModel(**state["sizes"], dropout=0))
+        model.load_state_dict(state["state_dict"])
+        model.requires_grad_(False)
+        return model
+
+    ntoken, d_model = state["encoder.weight"].shape
+    d_hid = state["transformer_encoder.layers.0.linear1.weight"].shape[0]
+    nlayers = len({k.split(".")[2] for k in state if k.startswith("transformer_encoder.layers.")})
+
+    model = TransformerModel(ntoken, d_model, nhead, d_hid, nlayers, dropout=0)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    model.requires_grad_(False)
+    return model